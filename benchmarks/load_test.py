@@ -0,0 +1,507 @@
+"""
+# Copyright (c) 2023 Fair Protocol
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+
+"""
+Load test of the model servers.
+
+Launches a server on a tiny randomly initialized stand-in model (built once
+in --model-dir), drives it with a fixed number of concurrent clients sending
+a reproducible mix of payload sizes, and prints throughput, latency
+percentiles, peak RSS and CPU utilisation of the server as JSON, e.g.
+
+    python benchmarks/load_test.py ai-detective --concurrency 1,4,16 --duration 30 --output before.json
+
+Every launched server runs on CPU, except dreamshaper, whose pipeline is
+hard-wired to CUDA: it needs a GPU, use dreamshaper-cpu on CPU hosts.
+
+--url drives a server that is already running instead (e.g. the arb-hack
+server on 8086), in which case its RSS and CPU are not measured.
+"""
+
+import argparse
+import http.client
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import threading
+import time
+import urllib.parse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SRC = os.path.join(ROOT, "src")
+
+# words per text payload, or images per request for Stable Diffusion
+SIZES = {"small": 16, "medium": 128, "large": 512}
+IMAGES = {"small": 1, "medium": 2, "large": 4}
+
+WORDS = (
+    "the model server request batch token image audio prompt network latency node queue worker "
+    "market protocol answer question data result project grant program success category report "
+    "quickly slowly often never always sometimes across between under over with without"
+).split()
+
+
+def text_payload(rng, words):
+    sentences = []
+    while words > 0:
+        length = min(words, rng.randint(8, 16))
+        sentence = " ".join(rng.choice(WORDS) for _ in range(length))
+        sentences.append(sentence[0].upper() + sentence[1:] + ".")
+        words -= length
+    return " ".join(sentences)
+
+
+def detector_request(rng, size):
+    return "/", text_payload(rng, SIZES[size]).encode("utf-8"), {"Content-Type": "text/plain"}
+
+
+def diffusion_request(rng, size):
+    params = {
+        "prompt": text_payload(rng, 12),
+        "steps": 2,
+        "width": 64,
+        "height": 64,
+        "batch_size": IMAGES[size],
+        "seed": rng.randrange(2**31),
+    }
+    return "/", json.dumps(params).encode("utf-8"), {"Content-Type": "application/json"}
+
+
+def tts_request(rng, size):
+    return "/", text_payload(rng, SIZES[size] // 4).encode("utf-8"), {"Content-Type": "text/plain"}
+
+
+def process_request(rng, size):
+    body = {"prompt": text_payload(rng, SIZES[size]), "type": "open"}
+    return "/process", json.dumps(body).encode("utf-8"), {"Content-Type": "application/json"}
+
+
+def make_tiny_gpt2(model_dir):
+    """Random GPT-2 with 2 small layers and a byte level BPE trained on WORDS, saved where ai-detective looks for it"""
+    from tokenizers import ByteLevelBPETokenizer
+    from transformers import GPT2Config, GPT2LMHeadModel, GPT2TokenizerFast
+    import torch
+
+    path = os.path.join(model_dir, "ai-detector")
+    if os.path.exists(os.path.join(path, "config.json")):
+        return
+    bpe = ByteLevelBPETokenizer()
+    bpe.train_from_iterator([text_payload(random.Random(i), 64) for i in range(200)], vocab_size=512, special_tokens=["<|endoftext|>"])
+    tokenizer = GPT2TokenizerFast(tokenizer_object=bpe._tokenizer, bos_token="<|endoftext|>", eos_token="<|endoftext|>", unk_token="<|endoftext|>")
+    torch.manual_seed(0)
+    model = GPT2LMHeadModel(GPT2Config(vocab_size=len(tokenizer), n_positions=1024, n_embd=64, n_layer=2, n_head=2))
+    model.save_pretrained(path)
+    tokenizer.save_pretrained(path)
+
+
+def _bytes_to_unicode():
+    # byte to printable character table of byte level BPE vocabularies
+    bs = list(range(ord("!"), ord("~") + 1)) + list(range(ord("¡"), ord("¬") + 1)) + list(range(ord("®"), ord("ÿ") + 1))
+    cs = bs[:]
+    n = 0
+    for b in range(256):
+        if b not in bs:
+            bs.append(b)
+            cs.append(256 + n)
+            n += 1
+    return [chr(c) for c in cs]
+
+
+def make_tiny_sd(model_dir):
+    """Random Stable Diffusion pipeline with 32 channel models, in the diffusers format dreamshaper loads"""
+    from diffusers import AutoencoderKL, PNDMScheduler, StableDiffusionPipeline, UNet2DConditionModel
+    from transformers import CLIPTextConfig, CLIPTextModel, CLIPTokenizer
+    import torch
+
+    path = os.path.join(model_dir, "tiny-sd")
+    if os.path.exists(os.path.join(path, "model_index.json")):
+        return
+    tokenizer_dir = os.path.join(model_dir, "tiny-sd-tokenizer")
+    os.makedirs(tokenizer_dir, exist_ok=True)
+    chars = _bytes_to_unicode()
+    vocab = {c: i for i, c in enumerate(chars)}
+    vocab.update({c + "</w>": len(chars) + i for i, c in enumerate(chars)})
+    vocab["<|startoftext|>"] = len(vocab)
+    vocab["<|endoftext|>"] = len(vocab)
+    with open(os.path.join(tokenizer_dir, "vocab.json"), "w") as f:
+        json.dump(vocab, f)
+    with open(os.path.join(tokenizer_dir, "merges.txt"), "w") as f:
+        f.write("#version: 0.2\n")
+    tokenizer = CLIPTokenizer(os.path.join(tokenizer_dir, "vocab.json"), os.path.join(tokenizer_dir, "merges.txt"), model_max_length=77)
+
+    torch.manual_seed(0)
+    text_encoder = CLIPTextModel(CLIPTextConfig(
+        vocab_size=len(vocab), hidden_size=32, intermediate_size=37, num_attention_heads=4, num_hidden_layers=2,
+        max_position_embeddings=77, bos_token_id=vocab["<|startoftext|>"], eos_token_id=vocab["<|endoftext|>"], pad_token_id=1,
+    ))
+    unet = UNet2DConditionModel(
+        block_out_channels=(32, 64), layers_per_block=1, sample_size=8, in_channels=4, out_channels=4,
+        down_block_types=("DownBlock2D", "CrossAttnDownBlock2D"), up_block_types=("CrossAttnUpBlock2D", "UpBlock2D"),
+        cross_attention_dim=32, norm_num_groups=8,
+    )
+    vae = AutoencoderKL(
+        block_out_channels=[32, 64], in_channels=3, out_channels=3, latent_channels=4, norm_num_groups=8,
+        down_block_types=["DownEncoderBlock2D"] * 2, up_block_types=["UpDecoderBlock2D"] * 2,
+    )
+    pipe = StableDiffusionPipeline(
+        vae=vae, text_encoder=text_encoder, tokenizer=tokenizer, unet=unet, scheduler=PNDMScheduler(skip_prk_steps=True),
+        safety_checker=None, feature_extractor=None, requires_safety_checker=False,
+    )
+    pipe.save_pretrained(path, safe_serialization=True)
+
+
+def make_tiny_vits(model_dir):
+    """Random VITS with 16 hidden channels and single layer encoders and flow, as a Coqui TTS checkpoint"""
+    from TTS.tts.configs.vits_config import VitsConfig
+    from TTS.tts.models.vits import Vits, VitsArgs
+    import torch
+
+    path = os.path.join(model_dir, "tiny-vits")
+    if os.path.exists(os.path.join(path, "config.json")):
+        return
+    os.makedirs(path, exist_ok=True)
+    config = VitsConfig(
+        model_args=VitsArgs(
+            hidden_channels=16,
+            hidden_channels_ffn_text_encoder=32,
+            num_layers_text_encoder=1,
+            num_layers_posterior_encoder=1,
+            num_layers_flow=1,
+            upsample_initial_channel_decoder=32,
+        ),
+        use_phonemes=False,
+        text_cleaner="english_cleaners",
+    )
+    torch.manual_seed(0)
+    model = Vits.init_from_config(config)
+    torch.save({"model": model.state_dict()}, os.path.join(path, "model.pth"))
+    model.config.save_json(os.path.join(path, "config.json"))
+
+
+def server_env(model_dir, name):
+    """Environment of a launched server in model_dir, on CPU except dreamshaper, which needs CUDA"""
+    env = dict(os.environ, OUTPUT_DIR=os.path.join(model_dir, "output"), RESULT_CACHE_DIR="")
+    if name == "ai-detective":
+        env["PPL_DEVICE"] = "cpu"
+    elif name.startswith("dreamshaper"):
+        env["SD_PRETRAINED_DIR"] = os.path.join(model_dir, "tiny-sd")
+    elif name == "vits":
+        env.update(
+            TTS_GPU="0",
+            TTS_MODEL_PATH=os.path.join(model_dir, "tiny-vits", "model.pth"),
+            TTS_CONFIG_PATH=os.path.join(model_dir, "tiny-vits", "config.json"),
+        )
+    return env
+
+
+# script, port, request builder and stand-in model of each server
+# (dreamshaper needs a CUDA GPU, dreamshaper-cpu is the same server on CPU)
+TARGETS = {
+    "ai-detective": ("ai-detective.py", 8087, detector_request, make_tiny_gpt2),
+    "dreamshaper": ("dreamshaper.py", 8088, diffusion_request, make_tiny_sd),
+    "dreamshaper-cpu": ("dreamshaper-cpu.py", 8088, diffusion_request, make_tiny_sd),
+    "vits": ("vits.py", 8089, tts_request, make_tiny_vits),
+    "process": (None, 8086, process_request, None),
+}
+
+# servers that only run on a GPU
+GPU_TARGETS = {"dreamshaper"}
+
+
+class ProcessSampler:
+    """
+    Samples the RSS of a process and its children from /proc while running,
+    and their CPU time over the measured window. peak_rss_bytes is the peak of the
+    whole run, window_peak_rss_bytes the peak since the last start_window(), so each
+    level reports its own. Linux only, values are None elsewhere.
+    """
+    def __init__(self, pid, interval_s=0.1):
+        self.pid = pid
+        self.interval_s = interval_s
+        self.peak_rss_bytes = None
+        self.window_peak_rss_bytes = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._page_size = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+        self._ticks = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+
+    def start(self):
+        self._thread.start()
+
+    def start_window(self):
+        """Starts a new window for window_peak_rss_bytes, from a fresh sample"""
+        rss = self._sample()
+        with self._lock:
+            self.window_peak_rss_bytes = rss
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def cpu_seconds(self):
+        """CPU time of the process tree, including children that already exited"""
+        total = 0
+        for pid in self._tree():
+            fields = self._stat(pid)
+            if fields is not None:
+                # utime, stime, cutime, cstime
+                total += sum(int(value) for value in fields[11:15])
+        return total / self._ticks if os.path.exists("/proc") else None
+
+    def _sample(self):
+        """Current RSS of the process tree, None without /proc"""
+        if not os.path.exists("/proc"):
+            return None
+        rss = 0
+        for pid in self._tree():
+            fields = self._stat(pid)
+            if fields is not None:
+                rss += int(fields[21]) * self._page_size
+        return rss
+
+    def _run(self):
+        while not self._stop.is_set():
+            rss = self._sample()
+            if rss is not None:
+                with self._lock:
+                    self.peak_rss_bytes = max(self.peak_rss_bytes or 0, rss)
+                    self.window_peak_rss_bytes = max(self.window_peak_rss_bytes or 0, rss)
+            self._stop.wait(self.interval_s)
+
+    def _tree(self):
+        if not os.path.exists("/proc"):
+            return []
+        parents = {}
+        for entry in os.listdir("/proc"):
+            if entry.isdigit():
+                fields = self._stat(int(entry))
+                if fields is not None:
+                    parents.setdefault(int(fields[1]), []).append(int(entry))
+        tree = [self.pid]
+        for pid in tree:
+            tree.extend(parents.get(pid, []))
+        return tree
+
+    @staticmethod
+    def _stat(pid):
+        # fields after the command name, which may contain spaces: state, ppid, ...
+        try:
+            with open(f"/proc/{pid}/stat") as f:
+                return f.read().rsplit(")", 1)[1].split()
+        except (OSError, IndexError):
+            return None
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of sorted values"""
+    if not values:
+        return None
+    rank = max(1, -(-len(values) * p // 100))
+    return values[int(rank) - 1]
+
+
+def send(url, path, body, headers, timeout_s):
+    parsed = urllib.parse.urlsplit(url)
+    connection = http.client.HTTPConnection(parsed.hostname, parsed.port, timeout=timeout_s)
+    try:
+        connection.request("POST", path, body=body, headers=headers)
+        response = connection.getresponse()
+        response.read()
+        return response.status
+    finally:
+        connection.close()
+
+
+def wait_ready(url, process, timeout_s):
+    """Polls GET /readyz until the server answers 200, e.g. while dreamshaper loads its model"""
+    parsed = urllib.parse.urlsplit(url)
+    deadline = time.monotonic() + timeout_s
+    while time.monotonic() < deadline:
+        if process is not None and process.poll() is not None:
+            raise RuntimeError(f"Server exited with code {process.returncode}")
+        try:
+            connection = http.client.HTTPConnection(parsed.hostname, parsed.port, timeout=5)
+            connection.request("GET", "/readyz")
+            if connection.getresponse().status == 200:
+                return
+        except OSError:
+            pass
+        time.sleep(0.5)
+    raise RuntimeError(f"Server not ready after {timeout_s}s")
+
+
+def run_level(url, build_request, mix, concurrency, args, sampler):
+    """Runs concurrency clients for args.duration seconds (or args.requests requests) and summarizes them"""
+    sizes = [size for size, _ in mix]
+    weights = [weight for _, weight in mix]
+    headers = {} if args.use_cache else {"Cache-Control": "no-cache"}
+    results = []
+    lock = threading.Lock()
+    issued = [0]
+
+    def client(index):
+        rng = random.Random(args.seed * 1000 + index)
+        deadline = start + args.duration
+        while True:
+            with lock:
+                if args.requests and issued[0] >= args.requests:
+                    return
+                issued[0] += 1
+            if not args.requests and time.monotonic() >= deadline:
+                return
+            size = rng.choices(sizes, weights)[0]
+            path, body, request_headers = build_request(rng, size)
+            sent = time.monotonic()
+            try:
+                status = send(url, path, body, dict(request_headers, **headers), args.timeout)
+            except OSError as e:
+                status = type(e).__name__
+            with lock:
+                results.append((size, status, time.monotonic() - sent))
+
+    if sampler:
+        sampler.start_window()
+    cpu_before = sampler.cpu_seconds() if sampler else None
+    start = time.monotonic()
+    clients = [threading.Thread(target=client, args=(i,)) for i in range(concurrency)]
+    for thread in clients:
+        thread.start()
+    for thread in clients:
+        thread.join()
+    elapsed = time.monotonic() - start
+    cpu_after = sampler.cpu_seconds() if sampler else None
+
+    def summarize(rows):
+        latencies = sorted(latency * 1000 for _, status, latency in rows if status == 200)
+        return {
+            "requests": len(rows),
+            "ok": len(latencies),
+            "rps": len(latencies) / elapsed if elapsed > 0 else None,
+            "latency_ms": {
+                "p50": percentile(latencies, 50),
+                "p95": percentile(latencies, 95),
+                "p99": percentile(latencies, 99),
+                "mean": sum(latencies) / len(latencies) if latencies else None,
+                "max": latencies[-1] if latencies else None,
+            },
+        }
+
+    statuses = {}
+    for _, status, _ in results:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    cpu_seconds = cpu_after - cpu_before if cpu_before is not None and cpu_after is not None else None
+    return dict(
+        summarize(results),
+        concurrency=concurrency,
+        duration_s=elapsed,
+        status_codes=statuses,
+        by_size={size: summarize([row for row in results if row[0] == size]) for size in sizes},
+        cpu_seconds=cpu_seconds,
+        # 100 is one core busy for the whole run
+        cpu_percent=100 * cpu_seconds / elapsed if cpu_seconds is not None and elapsed > 0 else None,
+        # peak of this level only, the peak of the whole run is in the report
+        peak_rss_mb=sampler.window_peak_rss_bytes / 2**20 if sampler and sampler.window_peak_rss_bytes else None,
+    )
+
+
+def parse_mix(value):
+    mix = []
+    for part in value.split(","):
+        size, _, weight = part.partition(":")
+        if size not in SIZES:
+            raise argparse.ArgumentTypeError(f"payload size must be one of {', '.join(SIZES)}")
+        mix.append((size, float(weight or 1)))
+    return mix
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test of a model server with a tiny stand-in model")
+    parser.add_argument("target", choices=sorted(TARGETS))
+    parser.add_argument("--url", help="drive this already running server instead of launching one")
+    parser.add_argument("--concurrency", default="1,4,16", help="comma separated numbers of concurrent clients, one run each")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("small:0.6,medium:0.3,large:0.1"), help="payload sizes and their weights")
+    parser.add_argument("--duration", type=float, default=20, help="seconds per concurrency level")
+    parser.add_argument("--requests", type=int, default=0, help="requests per concurrency level instead of a duration")
+    parser.add_argument("--warmup", type=int, default=3, help="requests sent before measuring")
+    parser.add_argument("--timeout", type=float, default=600, help="seconds before a request counts as failed")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the payloads, runs with the same seed send the same requests")
+    parser.add_argument("--use-cache", action="store_true", help="let the server answer repeated payloads from its result cache")
+    parser.add_argument("--model-dir", default=os.path.join(ROOT, ".bench-models"), help="where stand-in models are built and servers run")
+    parser.add_argument("--output", help="write the JSON report to this file too")
+    args = parser.parse_args()
+
+    script, port, build_request, make_model = TARGETS[args.target]
+    url = args.url or f"http://localhost:{port}"
+    process = None
+    sampler = None
+    if args.url is None:
+        if script is None:
+            parser.error(f"{args.target} can't be launched, pass the --url of a running server")
+        if args.target in GPU_TARGETS:
+            import torch
+            if not torch.cuda.is_available():
+                parser.error(f"{args.target} runs on CUDA and no GPU is available, use dreamshaper-cpu")
+        os.makedirs(args.model_dir, exist_ok=True)
+        make_model(args.model_dir)
+        # servers read their model and write their outputs relative to the working directory,
+        # their logs go to stderr to keep stdout for the report
+        process = subprocess.Popen(
+            [sys.executable, os.path.join(SRC, script)],
+            cwd=args.model_dir,
+            env=server_env(args.model_dir, args.target),
+            stdout=sys.stderr,
+        )
+        sampler = ProcessSampler(process.pid)
+        sampler.start()
+
+    try:
+        if process is not None:
+            wait_ready(url, process, args.timeout)
+        rng = random.Random(-1)
+        for _ in range(args.warmup):
+            path, body, headers = build_request(rng, args.mix[0][0])
+            send(url, path, body, headers, args.timeout)
+
+        levels = [run_level(url, build_request, args.mix, int(c), args, sampler) for c in args.concurrency.split(",")]
+    finally:
+        if sampler is not None:
+            sampler.stop()
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+    report = {
+        "target": args.target,
+        "url": url,
+        "mix": dict(args.mix),
+        "seed": args.seed,
+        "levels": levels,
+        "peak_rss_mb": sampler.peak_rss_bytes / 2**20 if sampler and sampler.peak_rss_bytes else None,
+        "host": {"python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count()},
+    }
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+
+
+if __name__ == "__main__":
+    main()
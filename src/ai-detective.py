@@ -18,9 +18,13 @@ import torch
 import re
 from transformers import GPT2LMHeadModel, GPT2TokenizerFast
 from collections import OrderedDict
-from http.server import BaseHTTPRequestHandler, HTTPServer
-from socketserver import ThreadingMixIn
 import json
+import os
+import time
+
+from batching import MicroBatcher
+from result_cache import ResultCache, bypass_cache
+from serving import AsyncHTTPServer, ModelServerHandler, metrics
 
 """
 # This code a slight modification of perplexity by hugging face
@@ -30,7 +34,7 @@ import json
 # by Burhan Ul tayyab and Nicholas Chua
 """
 class GPT2PPL:
-    def __init__(self, device="cuda", model_id="gpt2"):
+    def __init__(self, device="cuda", model_id="gpt2", batch_size=16, batch_tokens=2048, stride=512):
         self.device = device
         self.model_id = model_id
         path_dir = "./ai-detector/"
@@ -38,7 +42,17 @@ class GPT2PPL:
         self.tokenizer = GPT2TokenizerFast.from_pretrained(path_dir, local_files_only=True)
 
         self.max_length = self.model.config.n_positions
-        self.stride = 512
+        # tokens scored per sliding window, the remaining max_length - stride tokens
+        # of each window are context; a larger stride recomputes less context but
+        # leaves less of it to the first tokens of every window
+        self.stride = min(stride, self.max_length)
+
+        # lines are scored in padded batches of at most batch_size lines and
+        # batch_tokens padded tokens; batch_size=1 keeps the one-pass-per-line loop
+        self.batch_size = batch_size
+        self.batch_tokens = batch_tokens
+        # GPT-2 has no pad token, padded positions are masked out of the loss anyway
+        self.tokenizer.pad_token = self.tokenizer.eos_token
         
     def getResults(self, threshold):
         if threshold < 60:
@@ -53,7 +67,7 @@ class GPT2PPL:
             label = 1
             text = "A human most likely wrote this text." + "\n" + "Perplexity average: " + str(threshold)
             return text, label
-    def __call__(self, sentence):
+    def __call__(self, sentence, scorer=None):
         """
         Takes in a sentence split by full stop
         and print the perplexity of the total sentence
@@ -62,6 +76,9 @@ class GPT2PPL:
         average perplexity
 
         Burstiness is the max perplexity of each sentence
+
+        scorer replaces getPPLBatch to score the text and its lines,
+        e.g. to share batches with other requests
         """
         results = OrderedDict()
 
@@ -74,15 +91,44 @@ class GPT2PPL:
             total_valid_char_text = ""
             results["Less than 100 characters"] = False
         
-        lines = re.split(r'(?<=[.?!][ \[\(])|(?<=\n)\s*',sentence)
-        lines = list(filter(lambda x: (x is not None) and (len(x) > 0), lines))
+        lines = self.splitLines(sentence)
 
-        ppl = self.getPPL(sentence)
+        if scorer is not None or self.batch_size > 1:
+            ppls = (scorer or self.getPPLBatch)([sentence] + lines)
+            ppl, Perplexity_per_line = ppls[0], ppls[1:]
+        else:
+            ppl = self.getPPL(sentence)
+            Perplexity_per_line = [self.getPPL(line) for line in lines]
         print(f"Perplexity {ppl}")
         results["Perplexity"] = ppl
 
+        print(f"Perplexity per line {sum(Perplexity_per_line)/len(Perplexity_per_line)}")
+        results["Perplexity per line"] = sum(Perplexity_per_line)/len(Perplexity_per_line)
+
+        print(f"Burstiness {max(Perplexity_per_line)}")
+        results["Burstiness"] = max(Perplexity_per_line)
+
+        out, label = self.getResults(results["Perplexity per line"])
+        results["label"] = label
+
+        if total_valid_char < 100:
+            out = total_valid_char_text + "\n" + out
+
+        print(label)
+        print(out)
+
+        return results, out
+
+    def splitLines(self, sentence):
+        """
+        Splits the text by full stop and new lines, merging and trimming
+        the pieces into the lines that get scored
+        """
+        lines = re.split(r'(?<=[.?!][ \[\(])|(?<=\n)\s*',sentence)
+        lines = list(filter(lambda x: (x is not None) and (len(x) > 0), lines))
+
         offset = ""
-        Perplexity_per_line = []
+        scored_lines = []
         for i, line in enumerate(lines):
             if re.search("[a-zA-Z0-9]+", line) == None:
                 continue
@@ -97,43 +143,84 @@ class GPT2PPL:
             elif line[-1] == "[" or line[-1] == "(":
                 offset = line[-1]
                 line = line[:-1]
-            ppl = self.getPPL(line)
-            Perplexity_per_line.append(ppl)
-        print(f"Perplexity per line {sum(Perplexity_per_line)/len(Perplexity_per_line)}")
-        results["Perplexity per line"] = sum(Perplexity_per_line)/len(Perplexity_per_line)
+            scored_lines.append(line)
+        return scored_lines
 
-        print(f"Burstiness {max(Perplexity_per_line)}")
-        results["Burstiness"] = max(Perplexity_per_line)
+    def getPPLBatch(self, sentences):
+        """
+        Returns the same perplexities as calling getPPL on each sentence,
+        but scores every sentence that fits in a single window in padded,
+        length-sorted batches instead of one forward pass per sentence.
 
-        out, label = self.getResults(results["Perplexity per line"])
-        results["label"] = label
+        Each sentence is still scored on its own (right padding plus the
+        causal mask keep padded positions out of every real token's context),
+        so longer sentences simply fall back to the sliding window of getPPL.
+        """
+        with metrics.time("tokenize"):
+            encodings = [self.tokenizer(sentence).input_ids for sentence in sentences]
+        ppls = [None] * len(sentences)
 
-        if total_valid_char < 100:
-            out = total_valid_char_text + "\n" + out
+        batchable = []
+        for i, input_ids in enumerate(encodings):
+            if 1 < len(input_ids) <= self.max_length:
+                batchable.append(i)
+            else:
+                ppls[i] = self.getPPL(sentences[i])
+        batchable.sort(key=lambda i: len(encodings[i]))
 
-        print(label)
-        print(out)
+        batches = []
+        for i in batchable:
+            # sorted by length, so the sentence being added is the longest of its batch
+            if batches and len(batches[-1]) < self.batch_size \
+                    and (len(batches[-1]) + 1) * len(encodings[i]) <= self.batch_tokens:
+                batches[-1].append(i)
+            else:
+                batches.append([i])
 
-        return results, out
+        for batch in batches:
+            with metrics.time("tokenize"):
+                padded = self.tokenizer.pad({"input_ids": [encodings[i] for i in batch]}, return_tensors="pt")
+            input_ids = padded.input_ids.to(self.device)
+            attention_mask = padded.attention_mask.to(self.device)
+
+            with metrics.time("forward"), torch.no_grad():
+                logits = self.model(input_ids, attention_mask=attention_mask).logits
+                # shift so that tokens < n predict n, as GPT2LMHeadModel does with labels
+                shift_logits = logits[:, :-1, :].contiguous()
+                shift_labels = input_ids[:, 1:]
+                shift_mask = attention_mask[:, 1:]
+                token_nlls = torch.nn.functional.cross_entropy(
+                    shift_logits.view(-1, shift_logits.size(-1)),
+                    shift_labels.reshape(-1),
+                    reduction="none",
+                ).view(shift_labels.shape)
+                mean_nlls = (token_nlls * shift_mask).sum(dim=1) / shift_mask.sum(dim=1)
+
+            for i, mean_nll in zip(batch, mean_nlls):
+                ppls[i] = int(torch.exp(mean_nll))
+        return ppls
 
     def getPPL(self,sentence):
-        encodings = self.tokenizer(sentence, return_tensors="pt")
+        with metrics.time("tokenize"):
+            encodings = self.tokenizer(sentence, return_tensors="pt")
         seq_len = encodings.input_ids.size(1)
 
         nlls = []
-        likelihoods = []
         prev_end_loc = 0
         for begin_loc in range(0, seq_len, self.stride):
             end_loc = min(begin_loc + self.max_length, seq_len)
             trg_len = end_loc - prev_end_loc
             input_ids = encodings.input_ids[:, begin_loc:end_loc].to(self.device)
-            target_ids = input_ids.clone()
-            target_ids[:, :-trg_len] = -100
+            # the last trg_len tokens are the targets, the first token of the text has no prediction
+            trg_begin = max(input_ids.size(1) - trg_len, 1)
 
-            with torch.no_grad():
-                outputs = self.model(input_ids, labels=target_ids)
-                neg_log_likelihood = outputs.loss * trg_len
-                likelihoods.append(neg_log_likelihood)
+            with metrics.time("forward"), torch.no_grad():
+                # the overlapping context only goes through the transformer,
+                # the LM head just runs on the positions predicting a target
+                hidden_states = self.model.transformer(input_ids).last_hidden_state
+                logits = self.model.lm_head(hidden_states[0, trg_begin - 1:-1, :])
+                loss = torch.nn.functional.cross_entropy(logits, input_ids[0, trg_begin:])
+                neg_log_likelihood = loss * trg_len
 
             nlls.append(neg_log_likelihood)
 
@@ -143,12 +230,24 @@ class GPT2PPL:
         ppl = int(torch.exp(torch.stack(nlls).sum() / end_loc))
         return ppl
 
-model = GPT2PPL()
+loadStart = time.monotonic()
+model = GPT2PPL(device=os.environ.get("PPL_DEVICE", "cuda"), stride=int(os.environ.get("PPL_STRIDE", 512)))
+metrics.set("model_load_seconds", time.monotonic() - loadStart)
 
 hostName = "localhost"
 serverPort = 8087
 
-class MyServer(BaseHTTPRequestHandler):
+# lines of concurrent requests are scored together by a single inference worker
+maxBatchSize = int(os.environ.get("MAX_BATCH_SIZE", 32))
+maxWaitMs = float(os.environ.get("MAX_WAIT_MS", 10))
+scheduler = MicroBatcher(model.getPPLBatch, max_batch_size=maxBatchSize, max_wait_ms=maxWaitMs)
+metrics.gauge("model_queue_depth", scheduler.qsize)
+
+# scores are deterministic, so repeated prompts are answered from the cache
+cache = ResultCache.from_env(model.model_id, "ai-detective")
+cache.export(metrics, "ai-detective")
+
+class MyServer(ModelServerHandler):
   """ Server Class """
   def do_POST(self) -> None:
     if self.path == '/':
@@ -157,24 +256,28 @@ class MyServer(BaseHTTPRequestHandler):
       # Gets the data itself
       post_data = self.rfile.read(content_length)
       prompt = post_data.decode("utf-8")
-      results, out = model(prompt)
+      cache_key = cache.key({ "stride": model.stride }, prompt)
+      response = None if bypass_cache(self.headers) else cache.get(cache_key)
+      cache_status = "HIT" if response is not None else "MISS"
+      if response is None:
+        results, out = model(prompt, scorer=scheduler.submit)
+        json_dict = {
+          "details": results,
+          "result": out,
+        }
+        with metrics.time("encode"):
+          response = json.dumps(json_dict).encode('utf-8')
+        cache.put(cache_key, response)
       self.send_response(200)
       self.send_header("Content-Type", "application/json")
+      self.send_header("X-Cache", cache_status)
       self.end_headers()
-      json_dict = {
-        "details": results,
-        "result": out,
-      }
-      self.wfile.write(json.dumps(json_dict).encode('utf-8'))
+      self.wfile.write(response)
     else:
       self.send_error(404)
 
-class ThreadingSimpleServer(ThreadingMixIn, HTTPServer):
-    """ Threading Server Class """
-    pass
-
 if __name__ == "__main__":
-    webServer = ThreadingSimpleServer((hostName, serverPort), MyServer)
+    webServer = AsyncHTTPServer.from_env((hostName, serverPort), MyServer)
     print("Server started http://%s:%s" % (hostName, serverPort))
 
     try:
@@ -0,0 +1,99 @@
+"""
+# Copyright (c) 2023 Fair Protocol
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+
+import os
+import re
+import threading
+import time
+import uuid
+
+
+class ArtifactStore:
+    """
+    Hands out a unique output file per request, so concurrent requests never
+    overwrite each other, and runs a janitor thread that removes the files it
+    handed out once they are older than max_age_s or, oldest first, while
+    they add up to more than max_bytes.
+
+    Only files named <prefix>-<32 hex chars>[-<n>]<suffix> are ever removed,
+    so it is safe to point it at the directory holding the model files.
+    """
+    def __init__(self, output_dir, prefix, suffix, max_age_s=3600, max_bytes=2**30, interval_s=60):
+        self.output_dir = output_dir
+        self.prefix = prefix
+        self.suffix = suffix
+        self.max_age_s = max_age_s
+        self.max_bytes = max_bytes
+        self.interval_s = interval_s
+        self._name_re = re.compile(re.escape(prefix) + r"-[0-9a-f]{32}(-\d+)?" + re.escape(suffix) + "$")
+        os.makedirs(output_dir, exist_ok=True)
+
+    @classmethod
+    def from_env(cls, prefix, suffix):
+        """
+        Builds the store of one server from OUTPUT_DIR (the working directory
+        by default), ARTIFACT_MAX_AGE_S and ARTIFACT_MAX_MB
+        """
+        return cls(
+            os.environ.get("OUTPUT_DIR", os.getcwd()),
+            prefix,
+            suffix,
+            max_age_s=float(os.environ.get("ARTIFACT_MAX_AGE_S", 3600)),
+            max_bytes=int(float(os.environ.get("ARTIFACT_MAX_MB", 1024)) * 2**20),
+        )
+
+    def new_path(self) -> str:
+        return os.path.join(self.output_dir, f"{self.prefix}-{uuid.uuid4().hex}{self.suffix}")
+
+    def new_paths(self, count) -> [str]:
+        """Paths for several files of the same request, e.g. a batch of images"""
+        request_id = uuid.uuid4().hex
+        return [os.path.join(self.output_dir, f"{self.prefix}-{request_id}-{i}{self.suffix}") for i in range(count)]
+
+    def start_janitor(self) -> None:
+        threading.Thread(target=self._run_janitor, daemon=True).start()
+
+    def evict(self) -> None:
+        """Removes expired artifacts, then the oldest ones until under max_bytes"""
+        now = time.time()
+        artifacts = []
+        for entry in os.scandir(self.output_dir):
+            if not self._name_re.match(entry.name):
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            artifacts.append((stat.st_mtime, stat.st_size, entry.path))
+
+        artifacts.sort()
+        total_bytes = sum(size for _, size, _ in artifacts)
+        for mtime, size, path in artifacts:
+            if now - mtime <= self.max_age_s and total_bytes <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total_bytes -= size
+
+    def _run_janitor(self):
+        while True:
+            time.sleep(self.interval_s)
+            try:
+                self.evict()
+            except OSError as e:
+                print(f"Could not evict artifacts: {e}")
@@ -0,0 +1,128 @@
+"""
+# Copyright (c) 2023 Fair Protocol
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+
+from collections import deque
+import queue
+import threading
+import time
+
+
+class _Job:
+    """Items submitted by one caller and the results handed back to it"""
+    def __init__(self, items):
+        self.items = items
+        self.results = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class MicroBatcher:
+    """
+    Runs process_batch on a single worker thread, so the model is only ever
+    used by one thread at a time.
+
+    Items submitted by concurrent callers are coalesced into one call of
+    process_batch(items) -> results, up to max_batch_size items, waiting at
+    most max_wait_ms after the first item for the batch to fill up. Items of
+    one submit call are never split across batches.
+
+    item_size(item) counts an item as several (e.g. the images a request
+    asks for) and only items with the same batch_key(item) share a batch;
+    the others wait, in order, for a later batch.
+    """
+    def __init__(self, process_batch, max_batch_size=32, max_wait_ms=10, batch_key=None, item_size=None):
+        self.process_batch = process_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.batch_key = batch_key or (lambda item: None)
+        self.item_size = item_size or (lambda item: 1)
+        self._queue = queue.Queue()
+        self._worker = threading.Thread(target=self._run, daemon=True)
+        self._worker.start()
+
+    def submit(self, items):
+        """Queues the items and blocks until their results are ready"""
+        if len(items) == 0:
+            return []
+        job = _Job(list(items))
+        self._queue.put(job)
+        job.done.wait()
+        if job.error is not None:
+            raise job.error
+        return job.results
+
+    def qsize(self):
+        """Number of submit calls waiting for the worker"""
+        return self._queue.qsize()
+
+    def _run(self):
+        # jobs taken from the queue that didn't fit the batch being built
+        pending = deque()
+        while True:
+            job = pending.popleft() if pending else self._queue.get()
+            key = self._key(job)
+            jobs = [job]
+            size = self._size(job)
+
+            for other in list(pending):
+                if size >= self.max_batch_size:
+                    break
+                if self._key(other) == key and size + self._size(other) <= self.max_batch_size:
+                    pending.remove(other)
+                    jobs.append(other)
+                    size += self._size(other)
+
+            deadline = time.monotonic() + self.max_wait_ms / 1000
+            while size < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    job = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if self._key(job) != key:
+                    pending.append(job)
+                    continue
+                if size + self._size(job) > self.max_batch_size:
+                    # starts the next batch instead
+                    pending.append(job)
+                    break
+                jobs.append(job)
+                size += self._size(job)
+            self._process(jobs)
+
+    def _key(self, job):
+        return self.batch_key(job.items[0])
+
+    def _size(self, job):
+        return sum(self.item_size(item) for item in job.items)
+
+    def _process(self, jobs):
+        items = [item for job in jobs for item in job.items]
+        try:
+            results = self.process_batch(items)
+        except Exception as e:
+            for job in jobs:
+                job.error = e
+                job.done.set()
+            return
+
+        offset = 0
+        for job in jobs:
+            job.results = results[offset:offset + len(job.items)]
+            offset += len(job.items)
+            job.done.set()
@@ -0,0 +1,245 @@
+"""
+# Copyright (c) 2023 Fair Protocol
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+
+from diffusers import (
+    DDIMScheduler,
+    DPMSolverMultistepScheduler,
+    EulerAncestralDiscreteScheduler,
+    PNDMScheduler,
+    StableDiffusionPipeline,
+)
+from collections import OrderedDict
+import datetime
+import json
+import os
+import shutil
+import threading
+import torch
+
+# "default" keeps the scheduler the checkpoint was loaded with
+SCHEDULERS = {
+    "default": None,
+    "dpm++": DPMSolverMultistepScheduler,
+    "euler_a": EulerAncestralDiscreteScheduler,
+    "ddim": DDIMScheduler,
+    "pndm": PNDMScheduler,
+}
+
+# (min, max) accepted for each numeric parameter of a request
+LIMITS = {
+    "steps": (1, 100),
+    "batch_size": (1, 8),
+    "width": (64, 1024),
+    "height": (64, 1024),
+    "guidance_scale": (0, 30),
+    "seed": (0, 2**63 - 1),
+}
+
+
+def convert_checkpoint(checkpoint_path: str, pretrained_dir: str, torch_dtype=None) -> None:
+    """
+    Writes the single file checkpoint as a diffusers format directory with
+    safetensors weights in torch_dtype (float32 when None, whatever the
+    precision of the checkpoint). The directory only appears once complete,
+    so an interrupted conversion is redone.
+    """
+    if os.path.exists(os.path.join(pretrained_dir, "model_index.json")):
+        print(f"{pretrained_dir} is already converted")
+        return
+    if os.path.exists(pretrained_dir):
+        raise FileExistsError(
+            f"{pretrained_dir} exists but has no model_index.json, remove it or set "
+            "SD_PRETRAINED_DIR to another directory to convert the checkpoint"
+        )
+    print(f"Converting {checkpoint_path} to {pretrained_dir}")
+    pipe = StableDiffusionPipeline.from_ckpt(
+        checkpoint_path,
+        local_files_only=True,
+        use_safetensors=True,
+        load_safety_checker=False,
+        torch_dtype=torch_dtype,
+    )
+    partial_dir = pretrained_dir + ".partial"
+    shutil.rmtree(partial_dir, ignore_errors=True)
+    pipe.save_pretrained(partial_dir, safe_serialization=True)
+    os.rename(partial_dir, pretrained_dir)
+
+
+def load_pipeline(checkpoint_path: str, pretrained_dir: str, torch_dtype):
+    """
+    Loads the pipeline from its converted copy in pretrained_dir, whose
+    safetensors weights are memory-mapped rather than converted again from
+    the checkpoint on every start, converting it first if needed
+    """
+    if not os.path.exists(os.path.join(pretrained_dir, "model_index.json")):
+        convert_checkpoint(checkpoint_path, pretrained_dir, torch_dtype)
+    pipe = StableDiffusionPipeline.from_pretrained(
+        pretrained_dir,
+        local_files_only=True,
+        torch_dtype=torch_dtype,
+        use_safetensors=True,
+    )
+    pipe.safety_checker = None
+    pipe.requires_safety_checker = False
+    return pipe
+
+
+def parse_generation_request(body: str, defaults: dict, limits: dict = LIMITS) -> dict:
+    """
+    Reads the parameters of a generation request.
+
+    A plain text body is the prompt, generated with the server defaults. A JSON
+    object body { "prompt", "negative_prompt", "steps", "batch_size", "width",
+    "height", "guidance_scale", "seed", "scheduler" } overrides any of them
+    within limits. Raises ValueError with a message for the client otherwise.
+    """
+    params = dict(defaults, prompt=body)
+    try:
+        data = json.loads(body)
+    except ValueError:
+        return params
+    if not isinstance(data, dict):
+        return params
+
+    unknown = set(data) - set(params)
+    if unknown:
+        raise ValueError(f"Unknown parameters: {', '.join(sorted(unknown))}")
+    if not isinstance(data.get("prompt"), str):
+        raise ValueError("prompt must be a string")
+    if not isinstance(data.get("negative_prompt", ""), str):
+        raise ValueError("negative_prompt must be a string")
+    if data.get("scheduler", "default") not in SCHEDULERS:
+        raise ValueError(f"scheduler must be one of {', '.join(SCHEDULERS)}")
+
+    for name, (low, high) in limits.items():
+        value = data.get(name)
+        if value is None:
+            continue
+        number_types = (int, float) if name == "guidance_scale" else int
+        if isinstance(value, bool) or not isinstance(value, number_types) or not low <= value <= high:
+            raise ValueError(f"{name} must be a number between {low} and {high}")
+        if name in ("width", "height") and value % 8 != 0:
+            raise ValueError(f"{name} must be a multiple of 8")
+
+    params.update(data)
+    return params
+
+
+def get_inputs(params: dict, device: str) -> dict:
+    """Arguments of the pipeline call for the request parameters"""
+    seed = params.get("seed")
+    if seed is None:
+        seed = int(datetime.datetime.now().timestamp() * 1000)
+    batch_size = params["batch_size"]
+    generator = [torch.Generator(device).manual_seed(seed + i) for i in range(batch_size)]
+
+    return {
+        "prompt": batch_size * [params["prompt"]],
+        "negative_prompt": batch_size * [params["negative_prompt"]] if params.get("negative_prompt") else None,
+        "generator": generator,
+        "num_inference_steps": params["steps"],
+        "guidance_scale": params["guidance_scale"],
+        "width": params.get("width"),
+        "height": params.get("height"),
+    }
+
+
+def pipeline_for(pipe, scheduler_name: str):
+    """
+    A pipeline sharing the models of pipe with a fresh scheduler, so requests
+    can pick their own scheduler and never share its per-run state
+    """
+    scheduler_cls = SCHEDULERS[scheduler_name] or type(pipe.scheduler)
+    components = dict(pipe.components, scheduler=scheduler_cls.from_config(pipe.scheduler.config))
+    return StableDiffusionPipeline(**components, requires_safety_checker=False)
+
+
+def generation_key(params: dict):
+    """Requests with the same key can be generated in one pipeline call"""
+    return (params["steps"], params.get("width"), params.get("height"), params["guidance_scale"], params["scheduler"])
+
+
+class PromptEmbeddingCache:
+    """
+    LRU of text encoder outputs keyed on the prompt text and bounded by
+    max_bytes, so a prompt (or negative prompt) is encoded once no matter
+    how many images or requests use it.
+    """
+    def __init__(self, pipe, max_bytes=64 * 2**20):
+        self.pipe = pipe
+        self.max_bytes = max_bytes
+        self._embeddings = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, text: str):
+        """Embeddings of the text, shaped (1, tokens, hidden size)"""
+        with self._lock:
+            embeddings = self._embeddings.get(text)
+            if embeddings is not None:
+                self._embeddings.move_to_end(text)
+                return embeddings
+
+        embeddings = self._encode(text)
+        size = embeddings.numel() * embeddings.element_size()
+        with self._lock:
+            if text not in self._embeddings and size <= self.max_bytes:
+                self._embeddings[text] = embeddings
+                self._bytes += size
+                while self._bytes > self.max_bytes:
+                    _, evicted = self._embeddings.popitem(last=False)
+                    self._bytes -= evicted.numel() * evicted.element_size()
+        return embeddings
+
+    def _encode(self, text):
+        # same tokenization as the pipeline applies to prompt and negative_prompt
+        tokenizer = self.pipe.tokenizer
+        text_encoder = self.pipe.text_encoder
+        text_inputs = tokenizer(text, padding="max_length", max_length=tokenizer.model_max_length, truncation=True, return_tensors="pt")
+        with torch.no_grad():
+            embeddings = text_encoder(text_inputs.input_ids.to(text_encoder.device))[0]
+        return embeddings.to(dtype=text_encoder.dtype)
+
+
+def generate_batch(pipe, embeddings: PromptEmbeddingCache, batch: [dict], device: str) -> [list]:
+    """
+    Generates the images of several requests sharing a generation_key in a
+    single pipeline call, each with its own prompts and seeded generators,
+    and returns the list of images of every request
+    """
+    inputs = [get_inputs(params, device) for params in batch]
+    prompts = [prompt for request_inputs in inputs for prompt in request_inputs["prompt"]]
+    negative_prompts = []
+    for request_inputs in inputs:
+        # no negative prompt is the same as an empty one for the pipeline
+        negative_prompts += request_inputs["negative_prompt"] or len(request_inputs["prompt"]) * [""]
+
+    images = pipeline_for(pipe, batch[0]["scheduler"])(
+        prompt_embeds=torch.cat([embeddings.get(prompt) for prompt in prompts]),
+        negative_prompt_embeds=torch.cat([embeddings.get(prompt) for prompt in negative_prompts]),
+        generator=[generator for request_inputs in inputs for generator in request_inputs["generator"]],
+        num_inference_steps=inputs[0]["num_inference_steps"],
+        guidance_scale=inputs[0]["guidance_scale"],
+        width=inputs[0]["width"],
+        height=inputs[0]["height"],
+    ).images
+
+    results = []
+    offset = 0
+    for params in batch:
+        results.append(images[offset:offset + params["batch_size"]])
+        offset += params["batch_size"]
+    return results
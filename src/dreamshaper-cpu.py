@@ -14,46 +14,120 @@
 # limitations under the License.
 """
 
-from http.server import BaseHTTPRequestHandler, HTTPServer
-from socketserver import ThreadingMixIn
-from diffusers import StableDiffusionPipeline
 import os
+import io
 import json
-import datetime
+import sys
 import torch
 
-torch.backends.cuda.matmul.allow_tf32 = True
+from artifacts import ArtifactStore
+from batching import MicroBatcher
+from diffusion import LIMITS, SCHEDULERS, PromptEmbeddingCache, convert_checkpoint, generate_batch, generation_key, load_pipeline, parse_generation_request
+from result_cache import ResultCache, bypass_cache, pack, unpack
+from serving import AsyncHTTPServer, LazyModel, ModelServerHandler, accepts, metrics, multipart_chunks, new_boundary, send_chunked
 
-print("Loading Model\n")
-pipe = StableDiffusionPipeline.from_ckpt(
-  "./dreamshaper_631BakedVae-full.safetensors",
-  local_files_only=True,
-  torch_dtype=torch.float16,
-  use_safetensors=True
+# CPU engine settings: float32 is the safe default, bfloat16 halves the memory
+# and is faster on CPUs with AVX512-BF16/AMX
+dtypes = { "float32": torch.float32, "bfloat16": torch.bfloat16 }
+dtype_name = os.environ.get("SD_DTYPE", "float32")
+scheduler_name = os.environ.get("SD_SCHEDULER", "dpm++")
+num_inference_steps = int(os.environ.get("SD_STEPS", 20))
+batch_size = int(os.environ.get("SD_BATCH_SIZE", 1))
+num_threads = int(os.environ.get("SD_THREADS", 0))
+attention_slicing = os.environ.get("SD_ATTENTION_SLICING", "0") == "1"
+
+if num_threads > 0:
+  torch.set_num_threads(num_threads)
+
+model_path = "./dreamshaper_631BakedVae-full.safetensors"
+# diffusers format copy of the checkpoint, written once by --convert or on the first start
+pretrained_dir = os.environ.get("SD_PRETRAINED_DIR", os.path.splitext(model_path)[0])
+
+def load_model():
+  """Loads the pipeline for CPU inference and its prompt embedding cache"""
+  print("Loading Model\n")
+  pipe = load_pipeline(model_path, pretrained_dir, dtypes[dtype_name])
+  pipe.to("cpu")
+  # convolutions run faster on CPU with NHWC tensors
+  pipe.unet.to(memory_format=torch.channels_last)
+  pipe.vae.to(memory_format=torch.channels_last)
+  if attention_slicing:
+    # computes attention in slices to cap peak RAM, at some speed cost
+    pipe.enable_attention_slicing()
+  print(f"Model Loaded for CPU ({dtype_name}, {torch.get_num_threads()} threads)")
+  # every prompt and negative prompt only goes through the text encoder once
+  embeddings = PromptEmbeddingCache(pipe, max_bytes=int(float(os.environ.get("PROMPT_CACHE_MB", 64)) * 2**20))
+  return pipe, embeddings
+
+# loaded in the background once the server is listening
+model = LazyModel(load_model)
+metrics.gauge("model_load_seconds", lambda: model.load_seconds)
+
+def run_batch(batch: [dict]) -> [list]:
+  with metrics.time("forward"):
+    return generate_batch(*model.get(), batch, "cpu")
+
+# used for plain text prompts and for whatever a JSON request leaves out;
+# multistep solvers like dpm++ reach the quality of 50 PNDM steps in about 20
+defaults = {
+  "negative_prompt": "",
+  "steps": num_inference_steps,
+  "batch_size": batch_size,
+  "width": None,
+  "height": None,
+  "guidance_scale": 7.5,
+  "seed": None,
+  "scheduler": scheduler_name if scheduler_name in SCHEDULERS else "default",
+}
+# keeps the RAM and latency of a single request bounded on CPU
+limits = dict(LIMITS, steps=(1, 50), batch_size=(1, 4))
+
+# concurrent requests with the same resolution, steps, guidance and scheduler
+# share one pipeline call of up to MAX_BATCH_SIZE images
+batcher = MicroBatcher(
+  run_batch,
+  max_batch_size=int(os.environ.get("MAX_BATCH_SIZE", 4)),
+  max_wait_ms=float(os.environ.get("MAX_WAIT_MS", 50)),
+  batch_key=generation_key,
+  item_size=lambda params: params["batch_size"],
 )
+metrics.gauge("model_queue_depth", batcher.qsize)
 
-pipe.to("cpu")
-pipe.safety_checker = None
-pipe.requires_safety_checker = False
-print("Model Loaded for CPU")
-
-curr_dir = os.getcwd()
-def get_inputs(prompt = "", batch_size=1):      
-  current_time = int(datetime.datetime.now().timestamp() * 1000)                                                                                                                                                                                                           
-  generator = [torch.Generator("cuda").manual_seed(current_time + i) for i in range(batch_size)]                                                                                   
-  prompts = batch_size * [prompt]                                                                                                                                                                                                             
-  num_inference_steps = 50                                                                                                                                                                                                  
-
-  return {"prompt": prompts, "generator": generator, "num_inference_steps": num_inference_steps}
-  
-def gen_img(prompt: str) -> { "imgPaths": [str] }:
+# images only repeat for a pinned seed, so only those requests are cached
+cache = ResultCache.from_env(model_path, "dreamshaper")
+cache.export(metrics, "dreamshaper")
+
+# every request gets its own image files, old ones are removed in the background
+artifacts = ArtifactStore.from_env("result", ".png")
+artifacts.start_janitor()
+
+def gen_pngs(params: dict, use_cache: bool = True) -> [bytes]:
+  """Generates PNG encoded images for the request parameters, reusing cached images when the seed is pinned"""
+  settings = { name: value for name, value in params.items() if name != "prompt" }
+  settings["dtype"] = dtype_name
+  cache_key = cache.key(settings, params["prompt"])
+  pinned = params["seed"] is not None
+  cached = cache.get(cache_key) if pinned and use_cache else None
+  if cached is not None:
+    return unpack(cached)
+
+  pngs = []
+  for img in batcher.submit([params])[0]:
+    with metrics.time("encode"):
+      buffer = io.BytesIO()
+      img.save(buffer, 'png')
+      pngs.append(buffer.getvalue())
+  if pinned:
+    cache.put(cache_key, pack(pngs))
+  return pngs
+
+def gen_img(params: dict, use_cache: bool = True) -> { "imgPaths": [str] }:
   """Generates images from a prompt"""
-  images = pipe(**get_inputs(prompt,batch_size=4)).images
-  paths = []
-  for i, img in enumerate(images):
-    file_path = f"{curr_dir}/result-{i}.png"
-    img.save(file_path, 'png')
-    paths.append(file_path)
+  pngs = gen_pngs(params, use_cache=use_cache)
+  paths = artifacts.new_paths(len(pngs))
+  for file_path, png in zip(paths, pngs):
+    with metrics.time("save"), open(file_path, 'wb') as f:
+      f.write(png)
 
   return { "imgPaths": paths }
 
@@ -61,16 +135,34 @@ hostName = "localhost"
 serverPort = 8088
 
 
-class MyServer(BaseHTTPRequestHandler):
+class MyServer(ModelServerHandler):
   """Server Class"""
+  # /readyz and POST / answer 503 until the model is loaded
+  model = model
+
   def do_POST(self) -> None:
     if self.path == '/':
+      if not self.ready():
+        self.send_not_ready()
+        return
       # Gets the size of data
       content_length = int(self.headers['Content-Length'])
       # Gets the data itself
       post_data = self.rfile.read(content_length)
-      prompt = post_data.decode("utf-8")
-      result = gen_img(prompt)
+      try:
+        # either a plain text prompt or a JSON object with generation parameters
+        params = parse_generation_request(post_data.decode("utf-8"), defaults, limits)
+      except ValueError as e:
+        self.send_error(400, str(e))
+        return
+      use_cache = not bypass_cache(self.headers)
+      # clients accepting image/png get the images themselves instead of file paths
+      if accepts(self.headers, "image/png"):
+        boundary = new_boundary()
+        pngs = gen_pngs(params, use_cache=use_cache)
+        send_chunked(self, f"multipart/mixed; boundary={boundary}", multipart_chunks(pngs, "image/png", boundary))
+        return
+      result = gen_img(params, use_cache=use_cache)
       self.send_response(200)
       self.send_header("Content-Type", "application/json")
       self.end_headers()
@@ -78,13 +170,15 @@ class MyServer(BaseHTTPRequestHandler):
     else:
       self.send_error(404)
 
-class ThreadingSimpleServer(ThreadingMixIn, HTTPServer):
-    """Thread Server Class"""
-    pass
-
 if __name__ == "__main__":
-    webServer = ThreadingSimpleServer((hostName, serverPort), MyServer)
+    if "--convert" in sys.argv:
+        # one-time conversion, e.g. when the node is provisioned
+        convert_checkpoint(model_path, pretrained_dir, dtypes[dtype_name])
+        sys.exit(0)
+
+    webServer = AsyncHTTPServer.from_env((hostName, serverPort), MyServer)
     print("Server started http://%s:%s" % (hostName, serverPort))
+    model.start()
 
     try:
         webServer.serve_forever()
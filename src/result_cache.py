@@ -0,0 +1,214 @@
+"""
+# Copyright (c) 2023 Fair Protocol
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+
+from collections import OrderedDict
+import hashlib
+import json
+import os
+import struct
+import threading
+
+
+def bypass_cache(headers) -> bool:
+    """Requests sent with "Cache-Control: no-cache" skip the cache lookup"""
+    cache_control = headers.get("Cache-Control", "") or ""
+    return "no-cache" in cache_control.lower()
+
+
+def pack(parts: [bytes]) -> bytes:
+    """Frames several byte strings (e.g. a batch of images) into one cache value"""
+    return b"".join(struct.pack(">Q", len(part)) + part for part in parts)
+
+
+def unpack(value: bytes) -> [bytes]:
+    """Splits a value built by pack back into its parts"""
+    parts = []
+    offset = 0
+    while offset < len(value):
+        (size,) = struct.unpack_from(">Q", value, offset)
+        offset += 8
+        parts.append(value[offset:offset + size])
+        offset += size
+    return parts
+
+
+class ResultCache:
+    """
+    Content-addressed cache for response bodies.
+
+    Keys are a hash of (model id, settings, prompt). Values live in an
+    in-memory LRU bounded by max_memory_bytes, backed by an optional disk
+    directory bounded by max_disk_bytes, where the least recently used
+    files are evicted first. Disk hits are promoted back to memory.
+    """
+    def __init__(self, model_id, max_memory_bytes=64 * 2**20, disk_dir=None, max_disk_bytes=2**30):
+        self.model_id = model_id
+        self.max_memory_bytes = max_memory_bytes
+        self.disk_dir = disk_dir
+        self.max_disk_bytes = max_disk_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self._disk = OrderedDict()
+        self._disk_bytes = 0
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+            self._load_disk_index()
+
+    @classmethod
+    def from_env(cls, model_id, name):
+        """
+        Builds the cache of one server from RESULT_CACHE_MEMORY_MB,
+        RESULT_CACHE_DISK_MB and RESULT_CACHE_DIR (an empty dir keeps it in memory)
+        """
+        cache_dir = os.environ.get("RESULT_CACHE_DIR", os.path.join(os.getcwd(), "result-cache"))
+        return cls(
+            model_id,
+            max_memory_bytes=int(float(os.environ.get("RESULT_CACHE_MEMORY_MB", 64)) * 2**20),
+            disk_dir=os.path.join(cache_dir, name) if cache_dir else None,
+            max_disk_bytes=int(float(os.environ.get("RESULT_CACHE_DISK_MB", 1024)) * 2**20),
+        )
+
+    def key(self, settings, prompt) -> str:
+        """Hash of the model id, the settings that change the output and the prompt"""
+        payload = json.dumps([self.model_id, settings, prompt], sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        """Returns the cached bytes for the key, or None on a miss"""
+        with self._lock:
+            value = self._memory.get(key)
+            if value is not None:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return value
+            if key not in self._disk:
+                self.misses += 1
+                return None
+            self._disk.move_to_end(key)
+
+        try:
+            with open(self._disk_path(key), "rb") as f:
+                value = f.read()
+            os.utime(self._disk_path(key))
+        except OSError:
+            with self._lock:
+                self._forget_disk(key)
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.hits += 1
+            self._put_memory(key, value)
+        return value
+
+    def put(self, key, value: bytes) -> None:
+        with self._lock:
+            self._put_memory(key, value)
+        if self.disk_dir and len(value) <= self.max_disk_bytes:
+            self._put_disk(key, value)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "memory_entries": len(self._memory),
+                "memory_bytes": self._memory_bytes,
+                "disk_entries": len(self._disk),
+                "disk_bytes": self._disk_bytes,
+            }
+
+    def export(self, metrics, name) -> None:
+        """
+        Publishes the counters and sizes of the cache in metrics (a
+        serving.Metrics), labelled cache=name
+        """
+        def read():
+            stats = self.stats()
+            labels = {"cache": name}
+            return [
+                ("result_cache_hits_total", "counter", labels, stats["hits"]),
+                ("result_cache_misses_total", "counter", labels, stats["misses"]),
+                ("result_cache_entries", "gauge", dict(labels, tier="memory"), stats["memory_entries"]),
+                ("result_cache_entries", "gauge", dict(labels, tier="disk"), stats["disk_entries"]),
+                ("result_cache_bytes", "gauge", dict(labels, tier="memory"), stats["memory_bytes"]),
+                ("result_cache_bytes", "gauge", dict(labels, tier="disk"), stats["disk_bytes"]),
+            ]
+        metrics.collect(read)
+
+    def _put_memory(self, key, value):
+        if len(value) > self.max_memory_bytes:
+            return
+        previous = self._memory.pop(key, None)
+        if previous is not None:
+            self._memory_bytes -= len(previous)
+        self._memory[key] = value
+        self._memory_bytes += len(value)
+        while self._memory_bytes > self.max_memory_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= len(evicted)
+
+    def _put_disk(self, key, value):
+        path = self._disk_path(key)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(tmp_path, "wb") as f:
+                f.write(value)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"Could not write cache entry {key}: {e}")
+            return
+
+        evicted = []
+        with self._lock:
+            self._forget_disk(key)
+            self._disk[key] = len(value)
+            self._disk_bytes += len(value)
+            while self._disk_bytes > self.max_disk_bytes:
+                old_key, _ = next(iter(self._disk.items()))
+                self._forget_disk(old_key)
+                evicted.append(old_key)
+        for old_key in evicted:
+            try:
+                os.remove(self._disk_path(old_key))
+            except OSError:
+                pass
+
+    def _forget_disk(self, key):
+        size = self._disk.pop(key, None)
+        if size is not None:
+            self._disk_bytes -= size
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, key[:2], key)
+
+    def _load_disk_index(self):
+        entries = []
+        for root, _, files in os.walk(self.disk_dir):
+            for name in files:
+                path = os.path.join(root, name)
+                if name.endswith(".tmp"):
+                    os.remove(path)
+                    continue
+                stat = os.stat(path)
+                entries.append((stat.st_mtime, name, stat.st_size))
+        for _, key, size in sorted(entries):
+            self._disk[key] = size
+            self._disk_bytes += size
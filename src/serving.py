@@ -0,0 +1,489 @@
+"""
+# Copyright (c) 2023 Fair Protocol
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler
+import asyncio
+import io
+import os
+import threading
+import time
+import traceback
+import uuid
+
+CHUNK_SIZE = 64 * 1024
+
+# upper bounds in seconds of the latency histograms, from tokenizing a line to generating a batch of images
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+def accepts(headers, content_type) -> bool:
+    """Whether the client asked for content_type in its Accept header"""
+    accept = headers.get("Accept", "") or ""
+    return any(part.split(";")[0].strip() == content_type for part in accept.split(","))
+
+
+def iter_chunks(data: bytes, chunk_size=CHUNK_SIZE):
+    for offset in range(0, len(data), chunk_size):
+        yield data[offset:offset + chunk_size]
+
+
+def multipart_chunks(parts: [bytes], content_type, boundary):
+    """Frames each part as one multipart/mixed body part"""
+    for part in parts:
+        yield f"--{boundary}\r\nContent-Type: {content_type}\r\nContent-Length: {len(part)}\r\n\r\n".encode("ascii")
+        yield from iter_chunks(part)
+        yield b"\r\n"
+    yield f"--{boundary}--\r\n".encode("ascii")
+
+
+def new_boundary() -> str:
+    return uuid.uuid4().hex
+
+
+def send_unavailable(handler, message, retry_after=5) -> None:
+    """503 response asking the client to retry after retry_after seconds"""
+    body = message.encode("utf-8")
+    handler.send_response(503)
+    handler.send_header("Content-Type", "text/plain; charset=utf-8")
+    handler.send_header("Content-Length", str(len(body)))
+    handler.send_header("Retry-After", str(retry_after))
+    handler.end_headers()
+    handler.wfile.write(body)
+
+
+def send_chunked(handler, content_type, chunks, headers=None) -> None:
+    """
+    Streams the chunks as the response body of a BaseHTTPRequestHandler using
+    chunked transfer encoding, then closes the connection. HTTP/1.0 clients,
+    which don't support chunked encoding, get the raw body up to the close.
+    """
+    chunked = handler.request_version != "HTTP/1.0"
+    if chunked:
+        handler.protocol_version = "HTTP/1.1"
+    handler.send_response(200)
+    handler.send_header("Content-Type", content_type)
+    if chunked:
+        handler.send_header("Transfer-Encoding", "chunked")
+    for name, value in (headers or {}).items():
+        handler.send_header(name, value)
+    handler.send_header("Connection", "close")
+    handler.end_headers()
+
+    for chunk in chunks:
+        if not chunk:
+            continue
+        if chunked:
+            handler.wfile.write(b"%x\r\n" % len(chunk) + chunk + b"\r\n")
+        else:
+            handler.wfile.write(chunk)
+    if chunked:
+        handler.wfile.write(b"0\r\n\r\n")
+
+
+class LazyModel:
+    """
+    Loads a model with load() on a background thread once started, so the
+    server binds its port and answers readiness checks while the weights
+    are read instead of refusing connections.
+    """
+    def __init__(self, load):
+        self._load = load
+        self._model = None
+        self._loaded = threading.Event()
+        self.error = None
+        self.load_seconds = None
+
+    def start(self) -> None:
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def ready(self) -> bool:
+        return self._loaded.is_set() and self.error is None
+
+    def get(self):
+        """The loaded model, waiting for it if needed. Raises if loading failed."""
+        self._loaded.wait()
+        if self.error is not None:
+            raise RuntimeError("Model failed to load") from self.error
+        return self._model
+
+    def _run(self):
+        start = time.monotonic()
+        try:
+            self._model = self._load()
+            self.load_seconds = time.monotonic() - start
+        except Exception as e:
+            traceback.print_exc()
+            self.error = e
+        self._loaded.set()
+
+
+def _format_labels(labels) -> str:
+    if not labels:
+        return ""
+    escape = lambda value: str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+    return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in labels) + "}"
+
+
+class Metrics:
+    """
+    Counters, gauges and latency histograms of a server process, rendered
+    in the Prometheus text format by render()
+    """
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self._types = {}
+        self._values = {}
+        self._histograms = {}
+        self._callbacks = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def inc(self, name, labels=None, value=1) -> None:
+        """Adds value to a counter"""
+        self._add(name, "counter", labels, value)
+
+    def add(self, name, value, labels=None) -> None:
+        """Adds value, possibly negative, to a gauge"""
+        self._add(name, "gauge", labels, value)
+
+    def set(self, name, value, labels=None) -> None:
+        key = self._key(name, "gauge", labels)
+        with self._lock:
+            self._values[key] = value
+
+    def gauge(self, name, read) -> None:
+        """Gauge whose value is read() at every scrape, skipped while it returns None"""
+        with self._lock:
+            self._types[name] = "gauge"
+            self._callbacks[name] = read
+
+    def collect(self, read) -> None:
+        """
+        Samples computed at every scrape: read() returns a list of
+        (name, type, labels, value), e.g. the counters a cache keeps itself
+        """
+        with self._lock:
+            self._collectors.append(read)
+
+    def observe(self, name, value, labels=None) -> None:
+        """Records value in a histogram"""
+        key = self._key(name, "histogram", labels)
+        with self._lock:
+            buckets, count, total = self._histograms.get(key, ([0] * len(self.buckets), 0, 0.0))
+            buckets = [bucket + (value <= bound) for bucket, bound in zip(buckets, self.buckets)]
+            self._histograms[key] = (buckets, count + 1, total + value)
+
+    @contextmanager
+    def time(self, stage):
+        """Records the duration of the block in the latency histogram of a stage (tokenize, forward, encode, save...)"""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe_stage(stage, time.monotonic() - start)
+
+    def observe_stage(self, stage, seconds) -> None:
+        self.observe("model_stage_duration_seconds", seconds, {"stage": stage})
+
+    def render(self) -> str:
+        with self._lock:
+            types = dict(self._types)
+            values = dict(self._values)
+            histograms = dict(self._histograms)
+            callbacks = dict(self._callbacks)
+            collectors = list(self._collectors)
+
+        samples = {name: [] for name in types}
+        for (name, labels), value in sorted(values.items(), key=lambda item: str(item[0])):
+            samples[name].append(f"{name}{_format_labels(labels)} {value}")
+        for (name, labels), (buckets, count, total) in sorted(histograms.items(), key=lambda item: str(item[0])):
+            # buckets are cumulative, each counts the values up to its bound
+            for bound, bucket in zip(self.buckets, buckets):
+                samples[name].append(f"{name}_bucket{_format_labels(labels + (('le', bound),))} {bucket}")
+            samples[name].append(f"{name}_bucket{_format_labels(labels + (('le', '+Inf'),))} {count}")
+            samples[name].append(f"{name}_sum{_format_labels(labels)} {total}")
+            samples[name].append(f"{name}_count{_format_labels(labels)} {count}")
+        for name, read in callbacks.items():
+            value = read()
+            if value is not None:
+                samples[name].append(f"{name} {value}")
+        for read in collectors:
+            for name, metric_type, labels, value in read():
+                types.setdefault(name, metric_type)
+                samples.setdefault(name, []).append(f"{name}{_format_labels(tuple(sorted(labels.items())))} {value}")
+
+        lines = []
+        for name in sorted(samples):
+            if samples[name]:
+                lines.append(f"# TYPE {name} {types[name]}")
+                lines.extend(samples[name])
+        return "\n".join(lines) + "\n"
+
+    def _key(self, name, metric_type, labels):
+        with self._lock:
+            self._types.setdefault(name, metric_type)
+        return name, tuple(sorted((labels or {}).items()))
+
+    def _add(self, name, metric_type, labels, value):
+        key = self._key(name, metric_type, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+
+# metrics of this server process
+metrics = Metrics()
+
+
+class ModelServerHandler(BaseHTTPRequestHandler):
+    """
+    Base of the model servers' request handlers, answering GET /healthz (the
+    process is up), GET /readyz (the model is loaded) and GET /metrics, and
+    counting and timing every request by path and status.
+
+    Servers loading their model in the background set model to its LazyModel,
+    the others are only listening once their model is loaded. Paths that are
+    not in routes are counted as "other".
+    """
+    model = None
+    routes = ("/",)
+
+    def do_GET(self) -> None:
+        if self.path == "/healthz":
+            self.send_text("ok")
+        elif self.path == "/readyz":
+            if not self.ready():
+                self.send_not_ready()
+                return
+            self.send_text("ready")
+        elif self.path == "/metrics":
+            self.send_text(metrics.render(), "text/plain; version=0.0.4; charset=utf-8")
+        else:
+            self.send_error(404)
+
+    def ready(self) -> bool:
+        return self.model is None or self.model.ready()
+
+    def send_not_ready(self) -> None:
+        send_unavailable(self, "Model failed to load" if self.model.error else "Model is loading")
+
+    def send_text(self, text, content_type="text/plain; charset=utf-8") -> None:
+        body = text.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def parse_request(self) -> bool:
+        if not super().parse_request():
+            return False
+        self._started = time.monotonic()
+        metrics.add("http_requests_in_progress", 1)
+        return True
+
+    def log_request(self, code="-", size="-") -> None:
+        self._status = code
+        super().log_request(code, size)
+
+    def handle_one_request(self) -> None:
+        self._started = None
+        self._status = None
+        try:
+            super().handle_one_request()
+        finally:
+            if self._started is not None:
+                path = self.path.split("?")[0]
+                if path not in self.routes and path not in ("/healthz", "/readyz", "/metrics"):
+                    path = "other"
+                metrics.add("http_requests_in_progress", -1)
+                metrics.inc("http_requests_total", {"method": self.command, "path": path, "code": int(self._status or 0)})
+                metrics.observe("http_request_duration_seconds", time.monotonic() - self._started, {"path": path})
+
+
+class _Connection:
+    """
+    Socket stand-in handed to a BaseHTTPRequestHandler: it reads the request
+    already received by the event loop and writes the response through it,
+    waiting for the client to take the data so slow clients hold their
+    handler back instead of buffering the response in memory
+    """
+    def __init__(self, request: bytes, writer, loop):
+        self._request = request
+        self._writer = writer
+        self._loop = loop
+        self.sent = False
+        self.cancelled = False
+
+    def makefile(self, mode, buffering=None):
+        # responses go through sendall, handlers are unbuffered
+        return io.BytesIO(self._request)
+
+    def sendall(self, data) -> None:
+        if self.cancelled:
+            raise ConnectionAbortedError("Request timed out")
+        self.sent = True
+        asyncio.run_coroutine_threadsafe(self._write(bytes(data)), self._loop).result()
+
+    async def _write(self, data):
+        self._writer.write(data)
+        await self._writer.drain()
+
+    def settimeout(self, timeout) -> None:
+        pass
+
+    def setsockopt(self, *args) -> None:
+        pass
+
+
+def _status_response(code, reason, message, headers=None) -> bytes:
+    body = message.encode("utf-8")
+    lines = [f"HTTP/1.0 {code} {reason}", "Content-Type: text/plain; charset=utf-8", f"Content-Length: {len(body)}", "Connection: close"]
+    lines += [f"{name}: {value}" for name, value in (headers or {}).items()]
+    return ("\r\n".join(lines) + "\r\n\r\n").encode("ascii") + body
+
+
+class AsyncHTTPServer:
+    """
+    Drop-in replacement for a ThreadingMixIn HTTPServer: an asyncio event loop
+    accepts the connections and reads the requests, then runs the handler
+    class on at most max_concurrency threads, one request per connection.
+
+    At most max_queue requests wait for a thread, the next ones are answered
+    503 with Retry-After right away. A request still running after
+    request_timeout_s gets a 504 if nothing was sent yet and its connection
+    is closed; the handler is stopped at its next write. Health checks and
+    metrics skip the queue so probes keep working under load.
+    """
+    def __init__(self, server_address, RequestHandlerClass, max_concurrency=8, max_queue=64,
+                 request_timeout_s=600, header_timeout_s=30, max_body_bytes=16 * 2**20, retry_after_s=5):
+        self.server_address = server_address
+        self.RequestHandlerClass = RequestHandlerClass
+        self.max_queue = max_queue
+        self.request_timeout_s = request_timeout_s
+        self.header_timeout_s = header_timeout_s
+        self.max_body_bytes = max_body_bytes
+        self.retry_after_s = retry_after_s
+        self._executor = ThreadPoolExecutor(max_concurrency, thread_name_prefix="handler")
+        self._probe_executor = ThreadPoolExecutor(2, thread_name_prefix="probe")
+        self._queued = 0
+        self._loop = asyncio.new_event_loop()
+        self._slots = asyncio.Semaphore(max_concurrency)
+        # binds the port right away, as HTTPServer does
+        host, port = server_address
+        self._server = self._loop.run_until_complete(asyncio.start_server(self._handle, host, port))
+        metrics.gauge("http_requests_queued", lambda: self._queued)
+
+    @classmethod
+    def from_env(cls, server_address, RequestHandlerClass):
+        """Reads the limits from MAX_CONCURRENCY, MAX_QUEUE and REQUEST_TIMEOUT_S"""
+        return cls(
+            server_address,
+            RequestHandlerClass,
+            max_concurrency=int(os.environ.get("MAX_CONCURRENCY", 8)),
+            max_queue=int(os.environ.get("MAX_QUEUE", 64)),
+            request_timeout_s=float(os.environ.get("REQUEST_TIMEOUT_S", 600)),
+        )
+
+    def serve_forever(self) -> None:
+        self._loop.run_forever()
+
+    def server_close(self) -> None:
+        self._server.close()
+        self._loop.run_until_complete(self._server.wait_closed())
+        self._executor.shutdown(wait=False)
+        self._probe_executor.shutdown(wait=False)
+        self._loop.close()
+
+    async def _handle(self, reader, writer):
+        try:
+            request = await self._read_request(reader, writer)
+            if request is not None:
+                await self._dispatch(request, reader, writer)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except Exception:
+            traceback.print_exc()
+        finally:
+            writer.close()
+
+    async def _read_request(self, reader, writer):
+        """The raw bytes of the request, or None when it was already answered"""
+        try:
+            head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), self.header_timeout_s)
+        except asyncio.LimitOverrunError:
+            writer.write(_status_response(431, "Request Header Fields Too Large", "Request headers too large"))
+            return None
+        except asyncio.TimeoutError:
+            return None
+
+        content_length = 0
+        for line in head.split(b"\r\n")[1:]:
+            name, _, value = line.partition(b":")
+            if name.strip().lower() == b"content-length":
+                try:
+                    content_length = int(value)
+                except ValueError:
+                    content_length = -1
+        if not 0 <= content_length <= self.max_body_bytes:
+            writer.write(_status_response(413, "Payload Too Large", "Invalid or too large Content-Length"))
+            return None
+        try:
+            body = await asyncio.wait_for(reader.readexactly(content_length), self.header_timeout_s)
+        except asyncio.TimeoutError:
+            return None
+        return head + body
+
+    async def _dispatch(self, request, reader, writer):
+        client_address = writer.get_extra_info("peername")
+        connection = _Connection(request, writer, self._loop)
+        method, _, rest = request.partition(b" ")
+        path = rest.split(b" ", 1)[0].split(b"?")[0]
+        if method == b"GET" and path in (b"/healthz", b"/readyz", b"/metrics"):
+            await self._loop.run_in_executor(self._probe_executor, self.RequestHandlerClass, connection, client_address, self)
+            return
+
+        if self._queued >= self.max_queue:
+            metrics.inc("http_requests_rejected_total", {"reason": "queue_full"})
+            writer.write(_status_response(503, "Service Unavailable", "Server is busy", {"Retry-After": self.retry_after_s}))
+            return
+
+        self._queued += 1
+        try:
+            await self._slots.acquire()
+        finally:
+            self._queued -= 1
+        try:
+            if reader.at_eof():
+                # the client gave up while the request was queued
+                metrics.inc("http_requests_rejected_total", {"reason": "client_closed"})
+                return
+            future = self._loop.run_in_executor(self._executor, self.RequestHandlerClass, connection, client_address, self)
+            try:
+                await asyncio.wait_for(asyncio.shield(future), self.request_timeout_s)
+            except asyncio.TimeoutError:
+                metrics.inc("http_requests_rejected_total", {"reason": "timeout"})
+                connection.cancelled = True
+                if not connection.sent:
+                    writer.write(_status_response(504, "Gateway Timeout", "Request timed out"))
+                writer.close()
+                # the slot stays taken until the handler thread actually stops,
+                # usually failing on its next write to the cancelled connection
+                await asyncio.wait([future])
+                future.exception()
+        finally:
+            self._slots.release()
@@ -0,0 +1,176 @@
+"""
+# Copyright (c) 2023 Fair Protocol
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+
+import multiprocessing
+import os
+import queue
+import struct
+import threading
+import time
+
+import numpy as np
+
+# streamed WAV files don't know their length up front, players read until the end of the stream
+_UNKNOWN_SIZE = 0xFFFFFFFF
+
+
+def wav_stream_header(sample_rate, channels=1, bits_per_sample=16) -> bytes:
+    """RIFF/WAVE header for a PCM stream of unknown length"""
+    block_align = channels * bits_per_sample // 8
+    return b"".join([
+        b"RIFF", struct.pack("<I", _UNKNOWN_SIZE), b"WAVE",
+        b"fmt ", struct.pack("<IHHIIHH", 16, 1, channels, sample_rate, sample_rate * block_align, block_align, bits_per_sample),
+        b"data", struct.pack("<I", _UNKNOWN_SIZE),
+    ])
+
+
+def pcm16(wav) -> bytes:
+    """
+    Converts float samples in [-1, 1] to 16-bit PCM. Unlike saving a whole
+    file, chunks can't be normalized by the peak of the full utterance, so
+    samples are only clipped to keep every chunk at the same gain.
+    """
+    samples = np.clip(np.asarray(wav, dtype=np.float32), -1.0, 1.0)
+    return (samples * 32767).astype("<i2").tobytes()
+
+
+class _Done:
+    pass
+
+
+def pipelined(fn, items, prefetch=2):
+    """
+    Yields fn(item) for each item in order, while a background thread already
+    computes up to prefetch results ahead. Closing the generator (e.g. when
+    the client disconnects) stops the background thread after its current item.
+    """
+    results = queue.Queue(maxsize=prefetch)
+    stop = threading.Event()
+
+    def put(value):
+        while not stop.is_set():
+            try:
+                results.put(value, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def produce():
+        try:
+            for item in items:
+                if stop.is_set():
+                    return
+                put(fn(item))
+        except Exception as e:
+            put(e)
+            return
+        put(_Done)
+
+    threading.Thread(target=produce, daemon=True).start()
+    try:
+        while True:
+            result = results.get()
+            if result is _Done:
+                return
+            if isinstance(result, Exception):
+                raise result
+            yield result
+    finally:
+        stop.set()
+
+
+def normalize_sentence(sentence) -> str:
+    """Sentences differing only in whitespace sound the same"""
+    return " ".join(sentence.split())
+
+
+class UtteranceCache:
+    """
+    Synthesized float32 samples per normalized sentence, kept in a
+    result_cache.ResultCache so they share its byte-bounded LRU and its
+    optional disk tier.
+    """
+    def __init__(self, cache):
+        self.cache = cache
+
+    def get(self, sentence):
+        value = self.cache.get(self._key(sentence))
+        return None if value is None else np.frombuffer(value, dtype=np.float32)
+
+    def put(self, sentence, wav) -> None:
+        self.cache.put(self._key(sentence), np.asarray(wav, dtype=np.float32).tobytes())
+
+    def assemble(self, sentences, synthesize):
+        """
+        Yields the samples of every sentence in order, taking cached sentences
+        from the cache and the others from synthesize(missing_sentences),
+        which must yield their samples in order
+        """
+        cached = [self.get(sentence) for sentence in sentences]
+        missing = [sentence for sentence, wav in zip(sentences, cached) if wav is None]
+        fresh = iter(synthesize(missing)) if missing else iter(())
+        for sentence, wav in zip(sentences, cached):
+            if wav is None:
+                wav = next(fresh)
+                self.put(sentence, wav)
+            yield wav
+
+    def _key(self, sentence):
+        return self.cache.key({}, normalize_sentence(sentence))
+
+
+# the TTS instance the pool workers inherit when they are forked
+_pool_tts = None
+
+
+def _init_worker(num_threads):
+    import torch
+    torch.set_num_threads(num_threads)
+
+
+def _synthesize_sentence(sentence):
+    start = time.monotonic()
+    wav = np.asarray(_pool_tts.tts(text=sentence), dtype=np.float32)
+    return wav, time.monotonic() - start
+
+
+class SentencePool:
+    """
+    Synthesizes the sentences of a prompt in parallel on a pool of worker
+    processes, each running its own copy of the model with num_threads
+    torch threads.
+
+    Workers are forked once the model is loaded and before it runs, so they
+    share the parent's weights copy-on-write instead of loading them again.
+    Forking needs the model on CPU; CUDA can't be used across a fork.
+
+    timer(seconds) is called in this process with the synthesis time of
+    every sentence, which the workers measure.
+    """
+    def __init__(self, tts, processes, num_threads=None, timer=None):
+        global _pool_tts
+        _pool_tts = tts
+        num_threads = num_threads or max(1, (os.cpu_count() or 1) // processes)
+        self.processes = processes
+        self.timer = timer
+        self._pool = multiprocessing.get_context("fork").Pool(processes, initializer=_init_worker, initargs=(num_threads,))
+
+    def imap(self, sentences):
+        """Yields the float samples of each sentence, in order, as soon as they are ready"""
+        for wav, seconds in self._pool.imap(_synthesize_sentence, sentences):
+            if self.timer is not None:
+                self.timer(seconds)
+            yield wav
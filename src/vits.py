@@ -15,19 +15,109 @@
 """
 
 from TTS.api import TTS
-from http.server import BaseHTTPRequestHandler, HTTPServer
-from socketserver import ThreadingMixIn
 import json
+import io
 import os
+import time
+import numpy as np
+
+from artifacts import ArtifactStore
+from result_cache import ResultCache, bypass_cache
+from serving import AsyncHTTPServer, ModelServerHandler, accepts, iter_chunks, metrics, send_chunked
+from speech import SentencePool, UtteranceCache, pcm16, pipelined, wav_stream_header
 
 # Init TTS with the target model name
-tts = TTS(model_name="tts_models/en/ljspeech/vits", progress_bar=True, gpu=True)
+model_name = "tts_models/en/ljspeech/vits"
+use_gpu = os.environ.get("TTS_GPU", "1") == "1"
+# TTS_MODEL_PATH and TTS_CONFIG_PATH load a local checkpoint instead, e.g. the benchmarks' stand-in model
+model_path = os.environ.get("TTS_MODEL_PATH")
+loadStart = time.monotonic()
+if model_path:
+  model_name = model_path
+  tts = TTS(model_path=model_path, config_path=os.environ.get("TTS_CONFIG_PATH"), progress_bar=False, gpu=use_gpu)
+else:
+  tts = TTS(model_name=model_name, progress_bar=True, gpu=use_gpu)
+metrics.set("model_load_seconds", time.monotonic() - loadStart)
+
+# on CPU nodes, TTS_PROCESSES > 0 spreads the sentences of a prompt over that many worker processes
+processes = int(os.environ.get("TTS_PROCESSES", 0))
+pool = None
+if processes > 0 and use_gpu:
+  print("TTS_PROCESSES needs TTS_GPU=0, synthesizing in the server process")
+elif processes > 0:
+  pool = SentencePool(
+    tts,
+    processes,
+    num_threads=int(os.environ.get("TTS_THREADS_PER_PROCESS", 0)),
+    timer=lambda seconds: metrics.observe_stage("forward", seconds),
+  )
+  print(f"Synthesizing on {processes} worker processes")
+
+# repeated prompts are answered with the audio synthesized the first time
+cache = ResultCache.from_env(model_name, "vits")
+cache.export(metrics, "vits")
+
+# sentences shared between prompts (intros, disclaimers...) are only synthesized once,
+# UTTERANCE_CACHE_DIR also keeps them on disk across restarts
+utterance_dir = os.environ.get("UTTERANCE_CACHE_DIR")
+utterances = UtteranceCache(ResultCache(
+  model_name,
+  max_memory_bytes=int(float(os.environ.get("UTTERANCE_CACHE_MB", 256)) * 2**20),
+  disk_dir=utterance_dir or None,
+  max_disk_bytes=int(float(os.environ.get("UTTERANCE_CACHE_DISK_MB", 1024)) * 2**20),
+))
+utterances.cache.export(metrics, "vits_utterances")
+
+# every request gets its own output file, old ones are removed in the background
+artifacts = ArtifactStore.from_env("output", ".wav")
+artifacts.start_janitor()
+
+def split_sentences(prompt: str) -> [str]:
+  with metrics.time("tokenize"):
+    return tts.synthesizer.split_into_sentences(prompt)
+
+def synthesize_sentence(sentence: str):
+  with metrics.time("forward"):
+    return np.asarray(tts.tts(text=sentence), dtype=np.float32)
+
+def synthesize_sentences(sentences):
+  """Yields the float samples of each sentence in order, from the cache or the model"""
+  if pool is not None:
+    synthesize_missing = pool.imap
+  else:
+    synthesize_missing = lambda missing: pipelined(synthesize_sentence, missing)
+  return utterances.assemble(sentences, synthesize_missing)
+
+def encode_pcm(wav) -> bytes:
+  with metrics.time("encode"):
+    return pcm16(wav)
+
+def synthesize(prompt: str) -> bytes:
+  """Runs TTS and returns the WAV file bytes without going through disk"""
+  wavs = list(synthesize_sentences(split_sentences(prompt)))
+  # each sentence ends with the synthesizer's inter-sentence silence, as when synthesizing the whole prompt
+  wav = np.concatenate(wavs) if wavs else np.zeros(0, dtype=np.float32)
+  with metrics.time("encode"):
+    buffer = io.BytesIO()
+    tts.synthesizer.save_wav(wav, buffer)
+    return buffer.getvalue()
+
+def stream_sentences(prompt: str):
+  """
+  Yields a WAV stream for the prompt, one PCM chunk per sentence, synthesizing
+  the next sentence while the previous one is being sent
+  """
+  sentences = split_sentences(prompt)
+  yield wav_stream_header(tts.synthesizer.output_sample_rate)
+  yield from (encode_pcm(wav) for wav in synthesize_sentences(sentences))
 
 hostName = "localhost"
 serverPort = 8089
 
-class MyServer(BaseHTTPRequestHandler):
+class MyServer(ModelServerHandler):
   """Server Class Implementation"""
+  routes = ("/", "/stream")
+
   def do_POST(self) -> None:
     if self.path == '/':
       # Gets the size of data
@@ -35,22 +125,36 @@ class MyServer(BaseHTTPRequestHandler):
       # Gets the data itself
       post_data = self.rfile.read(content_length)
       prompt = post_data.decode("utf-8")
-      file_path = os.getcwd() + "/output.wav"
-      # Run TTS
-      tts.tts_to_file(text=prompt, file_path=file_path)
+      cache_key = cache.key({}, prompt)
+      audio = None if bypass_cache(self.headers) else cache.get(cache_key)
+      cache_status = "HIT" if audio is not None else "MISS"
+      if audio is None:
+        audio = synthesize(prompt)
+        cache.put(cache_key, audio)
+
+      # clients accepting audio/wav get the audio itself instead of a file path
+      if accepts(self.headers, "audio/wav"):
+        send_chunked(self, "audio/wav", iter_chunks(audio), { "X-Cache": cache_status })
+        return
+
+      file_path = artifacts.new_path()
+      with metrics.time("save"), open(file_path, "wb") as f:
+        f.write(audio)
       self.send_response(200)
       self.send_header("Content-Type", "application/json")
+      self.send_header("X-Cache", cache_status)
       self.end_headers()
       self.wfile.write(json.dumps( { "audioPath": file_path } ).encode('utf-8'))
+    elif self.path == '/stream':
+      content_length = int(self.headers['Content-Length'])
+      prompt = self.rfile.read(content_length).decode("utf-8")
+      # audio starts flowing as soon as the first sentence is synthesized
+      send_chunked(self, "audio/wav", stream_sentences(prompt))
     else:
       self.send_error(404)
 
-class ThreadingSimpleServer(ThreadingMixIn, HTTPServer):
-    """Thread Server Class"""
-    pass
-
 if __name__ == "__main__":
-    webServer = ThreadingSimpleServer((hostName, serverPort), MyServer)
+    webServer = AsyncHTTPServer.from_env((hostName, serverPort), MyServer)
     print("Server started http://%s:%s" % (hostName, serverPort))
 
     try:
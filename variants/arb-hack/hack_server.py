@@ -1,5 +1,5 @@
 from ollama import chat
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, stream_with_context
 from flask_cors import CORS
 import ollama
 import bs4
@@ -12,13 +12,17 @@ from langchain_core.runnables import RunnablePassthrough
 from llama_index.readers.web import BeautifulSoupWebReader
 import sys
 import json
+import os
 import re
+from concurrent.futures import ThreadPoolExecutor
 from fuzzywuzzy import process as fuzzy_process
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
-from prompts import get_prompt_by_question
-from rag import rag_chain_inference
+from prompts import get_prompt_by_question, load_prompts
+from rag import rag_chain_inference, rag_chain_stream
+from report_cache import ReportCache
 import requests
-import random
 
 app = Flask(__name__)
 CORS(app) 
@@ -26,6 +30,17 @@ CORS(app)
 runpod_id = 'twly873yxbkmmx' #replace with your runpod id or use the same approach as the file 'rag.py' to run the models on your own machine
 url = f"https://{runpod_id}-11434.proxy.runpod.net/api/generate"
 
+# report sections are generated in parallel, on at most report_workers keep-alive connections
+report_workers = int(os.environ.get("REPORT_WORKERS", 5))
+# (connect, read) seconds, a 405b generation can take minutes
+llm_timeout = (10, float(os.environ.get("LLM_TIMEOUT_S", 900)))
+session = requests.Session()
+# connection failures and gateway errors of the proxy are retried at once, then after 4s and 8s
+# (urllib3 sleeps backoff_factor * 2 ** (retry - 1), but not before the first retry); a read timeout
+# is not retried, the generation may still be running and a 900s wait must not be repeated
+retries = Retry(total=3, read=0, backoff_factor=2, status_forcelist=(502, 503, 504), allowed_methods=None, raise_on_status=False)
+session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=report_workers, max_retries=retries))
+
 # Data to send in the POST request
 
 def create_request(question,context):
@@ -46,38 +61,47 @@ questions_map = {
 
 def ollama_llm(question,context):
     data = create_request(question,context)
-    response = requests.post(url, json=data)
+    response = session.post(url, json=data, timeout=llm_timeout)
+    response.raise_for_status()
     response_data = response.json()
     return response_data.get('response', 'No response found.')
 
 
-def generate_report():
+def generate_report(prompts=None):
+    """The report and whether every section of it could be generated"""
+    prompts = prompts if prompts is not None else load_prompts()
     results = ""
-    for i in range(len(questions_map)):
-        question = questions_map[i]
-        try:
-            answer = ollama_llm(get_prompt_by_question(i),'')
-            results += f"** {question} ** </p><br>"
-            results += f"{answer} </p><br><br>" 
-        except:
-            results += f"** {question}** </p> Answer: It was not possible to generate this answer due to a temporary issue </p><br>" 
-    
-    return results
-
-
-def generate_report_cache():  #In case you want to use cache and not generate a new report everytime
-    random_number = random.randint(0, 4)
+    complete = True
+    with ThreadPoolExecutor(max_workers=report_workers) as executor:
+        futures = [executor.submit(ollama_llm, get_prompt_by_question(i, prompts), '') for i in range(len(questions_map))]
+        # sections keep the order of the questions, whichever finishes first
+        for i, future in enumerate(futures):
+            question = questions_map[i]
+            try:
+                answer = future.result()
+                results += f"** {question} ** </p><br>"
+                results += f"{answer} </p><br><br>" 
+            except Exception as e:
+                print(f"Could not generate the answer to question {i}: {e}")
+                complete = False
+                results += f"** {question}** </p> Answer: It was not possible to generate this answer due to a temporary issue </p><br>" 
     
-    filename = f"/home/fair-node/Desktop/arb-hack/reports_cache/report{random_number}.txt"
-    
-    try:
-        with open(filename, 'r', encoding='utf-8') as file:
-            content = file.read()
-        return content
-    except FileNotFoundError:
-        return f"Error: {filename} not found."
-    except Exception as e:
-        return f"Error while reading the file: {str(e)}"
+    return results, complete
+
+
+# the report is served from memory and regenerated in the background when the prompts or
+# the data files change, or when it is older than REPORT_MAX_AGE_S
+report_cache = ReportCache(
+    generate_report,
+    max_age_s=float(os.environ.get("REPORT_MAX_AGE_S", 24 * 3600)),
+    check_interval_s=float(os.environ.get("REPORT_CHECK_S", 60)),
+    # after failed generations, retries wait 60s, 120s, 240s... up to REPORT_MAX_BACKOFF_S
+    max_backoff_s=float(os.environ.get("REPORT_MAX_BACKOFF_S", 3600)),
+)
+
+def generate_report_cache():
+    report = report_cache.get()
+    return report if report is not None else "The report is being generated, please try again in a few minutes."
     
 
 
@@ -88,11 +112,36 @@ def home():
     #response = rag_chain_inference('Give me a short description of the project DeltaPrime')
     return response
 
+def ndjson_response(lines):
+    """Streams lines, one JSON object each, as they are produced"""
+    lines = (json.dumps(line) + "\n" for line in lines)
+    # proxies must not buffer the answer until it is complete
+    return Response(stream_with_context(lines), mimetype='application/x-ndjson', headers={'X-Accel-Buffering': 'no'})
+
+def stream_answer(tokens):
+    """{"token": ...} lines as the answer is generated, then {"done": true, "answer": <whole answer>}"""
+    answer = ""
+    try:
+        for token in tokens:
+            answer += token
+            yield {'token': token}
+    except Exception as e:
+        print(f"Could not generate the answer: {e}")
+        yield {'error': 'It was not possible to generate this answer due to a temporary issue'}
+        return
+    yield {'done': True, 'answer': answer}
+
 @app.route('/process', methods=['POST'])
 def process():
     data = request.get_json()
     prompt = data.get('prompt', '')
     question_type = data.get('type', '') #report or open
+
+    # with "stream": true the answer is sent as NDJSON while it is generated
+    if data.get('stream', False):
+        tokens = iter([generate_report_cache()]) if question_type == 'report' else rag_chain_stream(prompt)
+        return ndjson_response(stream_answer(tokens))
+
     answer = generate_report_cache() if question_type == 'report' else rag_chain_inference(prompt)
 
     full_answer = {
@@ -0,0 +1,137 @@
+from collections import Counter
+from langchain_core.documents import Document
+import math
+import threading
+import time
+
+from key_index import normalize
+
+# words too common to tell chunks apart, left out of the lexical index
+STOP_WORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "by", "can", "did", "do", "does", "for", "from", "has", "have",
+    "how", "in", "is", "it", "its", "of", "on", "or", "that", "the", "their", "they", "this", "to", "was",
+    "were", "what", "which", "who", "will", "with",
+}
+
+def tokenize(text):
+    return [word for word in normalize(text).split() if word not in STOP_WORDS]
+
+def chunk_key(doc):
+    return (doc.metadata.get("source"), doc.page_content)
+
+class BM25:
+    """Okapi BM25 over the chunks of the index, with an inverted index so a query only scores the chunks sharing a word with it"""
+    def __init__(self, docs, k1=1.5, b=0.75):
+        self.docs = docs
+        self.k1 = k1
+        self.b = b
+        self.lengths = []
+        self.postings = {}  # word -> [(position, frequency)]
+        for position, doc in enumerate(docs):
+            words = tokenize(doc.page_content)
+            self.lengths.append(len(words))
+            for word, frequency in Counter(words).items():
+                self.postings.setdefault(word, []).append((position, frequency))
+        self.average_length = sum(self.lengths) / len(docs) if docs else 0
+
+    def idf(self, word):
+        frequency = len(self.postings.get(word, ()))
+        return math.log(1 + (len(self.docs) - frequency + 0.5) / (frequency + 0.5))
+
+    def search(self, query, k, projects=None):
+        """The k best chunks for query, only among the chunks of projects when given"""
+        scores = Counter()
+        for word in set(tokenize(query)):
+            idf = self.idf(word)
+            for position, frequency in self.postings.get(word, ()):
+                length_norm = 1 - self.b + self.b * self.lengths[position] / self.average_length
+                scores[position] += idf * frequency * (self.k1 + 1) / (frequency + self.k1 * length_norm)
+        results = []
+        for position, _ in sorted(scores.items(), key=lambda item: (-item[1], item[0])):
+            doc = self.docs[position]
+            if projects is None or doc.metadata.get("project") in projects:
+                results.append(doc)
+                if len(results) == k:
+                    break
+        return results
+
+class BM25Index:
+    """
+    BM25 over every chunk of the Chroma index, kept in line with it: at most every check_interval_s
+    the chunk ids of the index are compared with those BM25 was built from, and BM25 is built again
+    when they differ. Ids change with the content of their page, so running rag_index.py while the
+    server is up is picked up at the next check.
+    """
+    def __init__(self, vectorstore, check_interval_s=60):
+        self.vectorstore = vectorstore
+        self.check_interval_s = check_interval_s
+        self.lock = threading.Lock()
+        self.bm25 = None
+        self.ids = None
+        self.checked_at = 0
+
+    def get(self):
+        with self.lock:
+            now = time.time()
+            if self.bm25 is None or now - self.checked_at >= self.check_interval_s:
+                self.checked_at = now
+                if set(self.vectorstore.get(include=[])['ids']) != self.ids:
+                    stored = self.vectorstore.get(include=["documents", "metadatas"])
+                    self.bm25 = BM25([Document(page_content=text, metadata=metadata) for text, metadata in zip(stored['documents'], stored['metadatas'])])
+                    self.ids = set(stored['ids'])
+            return self.bm25
+
+def reciprocal_rank_fusion(rankings, k=60):
+    """Chunks of several rankings ordered by the sum of 1 / (k + rank) over the rankings they appear in, with their scores"""
+    scores = Counter()
+    docs = {}
+    for ranking in rankings:
+        for rank, doc in enumerate(ranking, start=1):
+            scores[chunk_key(doc)] += 1 / (k + rank)
+            docs.setdefault(chunk_key(doc), doc)
+    return [(docs[key], score) for key, score in scores.most_common()]
+
+def jaccard(a, b):
+    return len(a & b) / len(a | b) if a or b else 1.0
+
+def maximal_marginal_relevance(scored_docs, k, diversity=0.3, duplicate_similarity=0.8):
+    """
+    Picks k chunks trading relevance for novelty, with the word overlap (Jaccard) of the chunks as similarity.
+    Chunks at duplicate_similarity or more with one already picked are dropped.
+    """
+    if not scored_docs:
+        return []
+    top_score = scored_docs[0][1]
+    candidates = [(doc, score / top_score, set(tokenize(doc.page_content))) for doc, score in scored_docs]
+    selected = []
+    while candidates and len(selected) < k:
+        best, best_value = None, None
+        for i, (doc, relevance, words) in enumerate(candidates):
+            similarity = max((jaccard(words, picked_words) for _, picked_words in selected), default=0.0)
+            if similarity >= duplicate_similarity:
+                continue
+            value = (1 - diversity) * relevance - diversity * similarity
+            if best_value is None or value > best_value:
+                best, best_value = i, value
+        if best is None:
+            break
+        doc, _, words = candidates.pop(best)
+        selected.append((doc, words))
+    return [doc for doc, _ in selected]
+
+class HybridRetriever:
+    """
+    Retrieves the chunks of projects for a question by fusing the vector search of the Chroma
+    index with BM25, then dropping near duplicates. Used like the retriever of as_retriever.
+    """
+    def __init__(self, vectorstore, bm25, projects, k=10, fetch_k=30):
+        self.vectorstore = vectorstore
+        self.bm25 = bm25
+        self.projects = projects
+        self.k = k
+        self.fetch_k = fetch_k
+
+    def invoke(self, question):
+        dense = self.vectorstore.similarity_search(question, k=self.fetch_k, filter={"project": {"$in": self.projects}})
+        lexical = self.bm25.search(question, self.fetch_k, set(self.projects))
+        return maximal_marginal_relevance(reciprocal_rank_fusion([dense, lexical]), self.k)
@@ -0,0 +1,168 @@
+from collections import Counter, deque
+import re
+import unicodedata
+
+# words that don't tell projects apart, "Across" is as good as "Across Protocol"
+GENERIC_WORDS = {"the", "protocol", "finance", "labs", "network", "foundation", "dao", "xyz"}
+
+def normalize(text):
+    """Folds case, accents and punctuation: "Contango.xyz" -> "contango xyz" """
+    text = unicodedata.normalize("NFKD", text).encode("ascii", "ignore").decode("ascii").lower()
+    return " ".join(re.findall(r"[a-z0-9]+", text))
+
+def compact(text):
+    """Normalized text without spaces, so "Delta Prime" matches "DeltaPrime" """
+    return normalize(text).replace(" ", "")
+
+def short_form_words(text):
+    """Normalized words without generic words and versions: "Uniswap V3" -> ["uniswap"]"""
+    return [word for word in normalize(text).split() if word not in GENERIC_WORDS and not re.fullmatch(r"v\d+", word)]
+
+def short_form(text):
+    return "".join(short_form_words(text))
+
+def trigrams(word):
+    padded = f"  {word} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+class KeyIndex:
+    """
+    Resolves the project names an LLM returns to the exact keys of the project map.
+
+    A name matches a key, or one of its aliases, when they are equal once case, accents,
+    punctuation and spaces are folded, with or without generic words. Otherwise the keys
+    sharing trigrams with it are scored by the Dice coefficient of their trigram sets, and
+    the best one is accepted only at min_score or above, ties going to the first key.
+    """
+    def __init__(self, keys, aliases=None, min_score=0.7, max_candidates=20):
+        self.keys = [key for key in keys if compact(key)]
+        self.min_score = min_score
+        self.max_candidates = max_candidates
+
+        self.exact = {}
+        for key in self.keys:
+            self.exact.setdefault(compact(key), key)
+        # short forms without generic words, unless two keys share one
+        short_forms = Counter(short_form(key) for key in self.keys)
+        for key in self.keys:
+            if short_form(key) and short_forms[short_form(key)] == 1:
+                self.exact.setdefault(short_form(key), key)
+        # an alias adds a name for a key, it never takes the name of another key
+        for alias, key in (aliases or {}).items():
+            if key not in self.keys:
+                raise ValueError(f"Alias {alias!r} is for {key!r}, which is not a key")
+            if self.exact.setdefault(compact(alias), key) != key:
+                raise ValueError(f"Alias {alias!r} for {key!r} is already the name of {self.exact[compact(alias)]!r}")
+
+        self.grams = [trigrams(compact(key)) for key in self.keys]
+        self.postings = {}
+        for position, grams in enumerate(self.grams):
+            for gram in grams:
+                self.postings.setdefault(gram, []).append(position)
+
+    def lookup(self, name):
+        """The key matching name, or None when no key is close enough"""
+        word = compact(name)
+        if not word:
+            return None
+        for form in (word, short_form(name)):
+            if form in self.exact:
+                return self.exact[form]
+
+        grams = trigrams(word)
+        shared = Counter()
+        for gram in grams:
+            shared.update(self.postings.get(gram, ()))
+        best_key, best_score = None, self.min_score
+        # most shared trigrams first, then key order, so results don't depend on hashing
+        for position, count in sorted(shared.items(), key=lambda item: (-item[1], item[0]))[:self.max_candidates]:
+            score = 2 * count / (len(grams) + len(self.grams[position]))
+            if score > best_score or (score == best_score and best_key is None):
+                best_key, best_score = self.keys[position], score
+        return best_key
+
+class ProjectMatcher:
+    """
+    Finds the projects named in a text in one pass, with an Aho-Corasick automaton over its
+    words whose patterns are the keys, their short forms and aliases.
+
+    Overlapping names resolve to the leftmost, then longest one. Single word names could be
+    plain words ("Across", "Compound"...), so they only count when capitalized in the text and
+    not just because they start a sentence; names of several words ("Across Protocol") always count.
+    """
+    def __init__(self, keys, aliases=None):
+        patterns = {}
+        short_forms = Counter(tuple(short_form_words(key)) for key in keys)
+        for key in keys:
+            patterns.setdefault(tuple(normalize(key).split()), key)
+            words = tuple(short_form_words(key))
+            if words and short_forms[words] == 1:
+                patterns.setdefault(words, key)
+        # an alias adds a name for a key, it never takes the name of another key
+        for alias, key in (aliases or {}).items():
+            if key not in keys:
+                raise ValueError(f"Alias {alias!r} is for {key!r}, which is not a key")
+            words = tuple(normalize(alias).split())
+            if patterns.setdefault(words, key) != key:
+                raise ValueError(f"Alias {alias!r} for {key!r} is already the name of {patterns[words]!r}")
+        patterns.pop((), None)
+
+        # trie of the pattern words, node 0 is the root
+        self.goto = [{}]
+        self.outputs = [[]]
+        for words, key in patterns.items():
+            node = 0
+            for word in words:
+                if word not in self.goto[node]:
+                    self.goto.append({})
+                    self.outputs.append([])
+                    self.goto[node][word] = len(self.goto) - 1
+                node = self.goto[node][word]
+            self.outputs[node].append((len(words), key))
+
+        # failure links, breadth first, so every node inherits the outputs of its longest proper suffix
+        self.fail = [0] * len(self.goto)
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for word, child in self.goto[node].items():
+                fallback = self.fail[node]
+                while fallback and word not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[child] = self.goto[fallback].get(word, 0)
+                self.outputs[child] = self.outputs[child] + self.outputs[self.fail[child]]
+                queue.append(child)
+
+    def find(self, text):
+        """Keys of the projects named in text, in order of appearance"""
+        tokens = list(re.finditer(r"[^\W_]+", text))
+        words = [compact(token.group()) for token in tokens]
+
+        matches = []
+        node = 0
+        for end, word in enumerate(words):
+            while node and word not in self.goto[node]:
+                node = self.fail[node]
+            node = self.goto[node].get(word, 0)
+            for length, key in self.outputs[node]:
+                start = end - length + 1
+                if length > 1 or self._capitalized(text, tokens[start]):
+                    matches.append((start, -length, key))
+
+        projects = []
+        covered_until = 0
+        for start, negative_length, key in sorted(matches):
+            if start >= covered_until:
+                covered_until = start - negative_length
+                if key not in projects:
+                    projects.append(key)
+        return projects
+
+    @staticmethod
+    def _capitalized(text, token):
+        word = token.group()
+        if not word[:1].isupper():
+            return False
+        sentence_start = re.search(r"(^|[.?!:]\s*|\n\s*)$", text[:token.start()]) is not None
+        # "DeltaPrime" or "Layer3" are names wherever they are
+        return not sentence_start or any(c.isupper() or c.isdigit() for c in word[1:])
@@ -1,34 +1,23 @@
 from token_count import TokenCount
+import glob
+import hashlib
+import os
+
+# the directory holding data/ and reports_cache/, the directory of this script unless ARB_HACK_DIR is set
+BASE_DIR = os.environ.get("ARB_HACK_DIR", os.path.dirname(os.path.abspath(__file__)))
+DATA_DIR = os.path.join(BASE_DIR, "data")
+
+# data files filling the placeholders of the prompts
+data_files = {
+    "content_ltipp_analysis": "ltipp_analysis.txt",
+    "content_amount_requested": "amount_requested.txt",
+    "content_general_description": "general_description.txt",
+    "content_good_post_ltipp": "proposals_with_good_results.txt",
+    "content_deltaprime_results": "deltaprimeresults.txt",
+    "content_grant_goals": "grant_goals.txt",
+}
 
-#Read Files
-file_ltipp_analysis = open("/home/fair-node/Desktop/arb-hack/data/ltipp_analysis.txt", "r")
-content_ltipp_analysis = file_ltipp_analysis.read()
-file_ltipp_analysis.close()
-
-file_amount_requested = open("/home/fair-node/Desktop/arb-hack/data/amount_requested.txt", "r")
-content_amount_requested = file_amount_requested.read()
-file_amount_requested.close()
-
-file_general_description = open("/home/fair-node/Desktop/arb-hack/data/general_description.txt", "r")
-content_general_description = file_general_description.read()
-file_general_description.close()
-
-file_good_post_ltipp = open("/home/fair-node/Desktop/arb-hack/data/proposals_with_good_results.txt", "r")
-content_good_post_ltipp = file_good_post_ltipp.read()
-file_good_post_ltipp.close()
-
-file_deltaprime_results = open("/home/fair-node/Desktop/arb-hack/data/deltaprimeresults.txt", "r")
-content_deltaprime_results = file_deltaprime_results.read()
-file_deltaprime_results.close()
-
-file_grant_goals = open("/home/fair-node/Desktop/arb-hack/data/grant_goals.txt", "r")
-content_grant_goals = file_grant_goals.read()
-file_grant_goals.close()
-
-#print(content_ltipp_analysis)
-
-
-prompt_result_amount = f""" Here is a list of projects that participated in Arbitrum's LTIPP (Long Term Incentives Pilot Program) and the amount of ARBs they requested: {content_amount_requested}
+prompt_result_amount = """ Here is a list of projects that participated in Arbitrum's LTIPP (Long Term Incentives Pilot Program) and the amount of ARBs they requested: {content_amount_requested}
 
 The program has already ended, and OpenBlock carried out the following study: {content_ltipp_analysis}
 
@@ -38,7 +27,7 @@ The report should be short.
 """
     
 
-prompt_result_category = f""" Here is a list of projects that participated in Arbitrum's LTIPP (Long Term Incentives Pilot Program). This list contains the name, a short description, and how many ARBs they requested in their proposed grant. The list is as follows: {content_general_description}
+prompt_result_category = """ Here is a list of projects that participated in Arbitrum's LTIPP (Long Term Incentives Pilot Program). This list contains the name, a short description, and how many ARBs they requested in their proposed grant. The list is as follows: {content_general_description}
 
 The program has already ended, and OpenBlock carried out the following study: {content_ltipp_analysis}
 
@@ -47,7 +36,7 @@ I want you to create a report that groups projects by category and want you to d
 The report should be short.
 """
 
-prompt_top_five = f""" Here is a summary of the goals of the projects that received grants in Arbitrum's LTIPP program. {content_grant_goals}
+prompt_top_five = """ Here is a summary of the goals of the projects that received grants in Arbitrum's LTIPP program. {content_grant_goals}
 
 
 These were the results they achieved: {content_ltipp_analysis} and {content_deltaprime_results}
@@ -59,13 +48,13 @@ Based on these data: What are the top 5 projects that have achieved success base
 
 
 
-prompt_good_post_ltipp = f""" {content_good_post_ltipp} 
+prompt_good_post_ltipp = """ {content_good_post_ltipp} 
 
 These projects participated in Arbitrum's LTIPP (Long Term Incentives Pilot Program) and were successful. This was a resume of their grant goals. Can you find any patterns between them that could provide a justification for their success?
 The report should be short.
 """   
 
-prompt_result_deltaprime = f""" Here is a list of projects that participated in Arbitrum's LTIPP (Long Term Incentives Pilot Program). This list contains the name, a short description, and how many ARBs they requested in their proposed grant. The list is as follows: {content_general_description}
+prompt_result_deltaprime = """ Here is a list of projects that participated in Arbitrum's LTIPP (Long Term Incentives Pilot Program). This list contains the name, a short description, and how many ARBs they requested in their proposed grant. The list is as follows: {content_general_description}
 
 The program has already ended, and OpenBlock carried out the following study: {content_ltipp_analysis}
 
@@ -78,7 +67,7 @@ I would appreciate your help in generating a report that analyzes how DeltaPrime
 
 
 
-prompts_map = {
+prompt_templates = {
     0: prompt_result_amount,
     1: prompt_result_category,
     2: prompt_top_five,
@@ -92,8 +81,33 @@ def count_text_tokens(content):
     return tc.num_tokens_from_string(content)
 
 
-def get_prompt_by_question(id_question):
-    return prompts_map.get(id_question,"Invalid question number")
+def load_data():
+    """Content of the data files by placeholder name, read again on every call"""
+    data = {}
+    for name, filename in data_files.items():
+        with open(os.path.join(DATA_DIR, filename), "r") as file_data:
+            data[name] = file_data.read()
+    return data
+
+
+def load_prompts():
+    """The report prompts by question number, built from the current data files"""
+    data = load_data()
+    return {id_question: template.format(**data) for id_question, template in prompt_templates.items()}
+
+
+def inputs_hash(prompts):
+    """Hash of the prompt texts and of every data/*.txt file, changes whenever a report built from them would"""
+    digest = hashlib.sha256()
+    for id_question in sorted(prompts):
+        digest.update(prompts[id_question].encode("utf-8"))
+    for path in sorted(glob.glob(os.path.join(DATA_DIR, "*.txt"))):
+        digest.update(os.path.basename(path).encode("utf-8"))
+        with open(path, "rb") as file_data:
+            digest.update(file_data.read())
+    return digest.hexdigest()
 
-    
 
+def get_prompt_by_question(id_question, prompts=None):
+    prompts = prompts if prompts is not None else load_prompts()
+    return prompts.get(id_question,"Invalid question number")
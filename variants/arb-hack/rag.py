@@ -1,13 +1,14 @@
 from flask import Flask, request, jsonify
 from flask_cors import CORS
 import ollama
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_community.document_loaders import WebBaseLoader
-from langchain_community.vectorstores import Chroma
-from langchain_community.embeddings import OllamaEmbeddings
 import json
+import os
 import re
-from fuzzywuzzy import process as fuzzy_process
+
+from hybrid_search import BM25Index, HybridRetriever
+from key_index import KeyIndex, ProjectMatcher
+from rag_index import GENERAL_KEY, index_data_files, is_empty, open_index, project_pages, update_index
+from snapshots import refresh_snapshots
 
 app = Flask(__name__)
 CORS(app) 
@@ -15,16 +16,28 @@ CORS(app)
 #Read Files
 file_ltipp = open("/home/fair-node/Desktop/arb-hack/ltipp_keys", "r")
 content_ltipp = file_ltipp.read()
-keys_list_ltipp = [line.strip() for line in content_ltipp.splitlines()]
 file_ltipp.close()
 
 file_ltipp_map  = open("/home/fair-node/Desktop/arb-hack/ltipp.json", "r")
 ltipp_map = json.load(file_ltipp_map)
 file_ltipp_map.close()
 
-def find_closest_match(input_string, array_of_strings):
-    closest_match, score = fuzzy_process.extractOne(input_string, array_of_strings)
-    return closest_match, score
+# persistent index of the project pages, only built here on the first start,
+# from snapshots of the pages so no request ever waits on a page fetch
+vectorstore = open_index()
+if is_empty(vectorstore):
+    refresh_snapshots([url for _, url in project_pages(ltipp_map)], only_missing=True)
+    update_index(ltipp_map, vectorstore)
+else:
+    # the curated data files are local, so they are brought up to date on every start
+    index_data_files(vectorstore)
+# lexical index of the same chunks, rebuilt when they change
+bm25_index = BM25Index(vectorstore, check_interval_s=float(os.environ.get("RAG_BM25_CHECK_S", 60)))
+# chunks sent to the LLM for a question
+rag_top_k = int(os.environ.get("RAG_TOP_K", 10))
+
+key_index = KeyIndex(ltipp_map)
+project_matcher = ProjectMatcher(ltipp_map)
 
 def get_json_from_llm(string_json_raw):
     json_str = re.search(r'{.*}', string_json_raw, re.DOTALL).group()
@@ -46,45 +59,13 @@ def convert_json_to_object(string_json):
         keys = []    
     return keys
 
-def convert_keys_into_urls(keys):
-    all_urls = []
+def convert_keys_into_projects(keys):
+    projects = []
     for key in keys:
-        key_values = ltipp_map.get(key)
-        if key_values:
-            all_urls.extend(key_values) 
-        else:
-            closest_key, score = find_closest_match(key,keys_list_ltipp)
-            if score != 0:
-                new_keys = ltipp_map.get(closest_key)
-                all_urls.extend(new_keys)
-    return all_urls    
-    
-
-def process_and_embeddings(string_json): 
-    keys = convert_json_to_object(string_json)
-    urls = convert_keys_into_urls(keys)
-    urls.append('https://www.openblocklabs.com/research/arbitrum-ltipp-efficacy-analysis') # this is to include the report and provide better answers
-    
-        
-    loader = WebBaseLoader(
-        web_paths=(urls),
-    )
-    docs = loader.load()
-
-    text_splitter = RecursiveCharacterTextSplitter(chunk_size=2000, chunk_overlap=200)
-    splits = text_splitter.split_documents(docs)
-
-    # 2. Create Ollama embeddings and vector store
-    embeddings = OllamaEmbeddings(model="nomic-embed-text")
-    vectorstore = Chroma()
-    
-    # it's necessary to remove the old context from previous request because Chroma stores that into ephemeral in-memory.
-    old_context_ids = vectorstore.get()['ids']
-    if old_context_ids:
-        vectorstore.delete(ids= old_context_ids)
-        
-    vectorstore = Chroma.from_documents(documents=splits, embedding=embeddings)
-    return vectorstore
+        project = key_index.lookup(key) if isinstance(key, str) else None
+        if project and project not in projects:
+            projects.append(project)
+    return projects
 
 # 3. Call Ollama Llama3 model
 def ollama_llm(question, context):
@@ -94,6 +75,13 @@ def ollama_llm(question, context):
     #response = ollama.chat(model='llama3', messages=[{'role': 'user', 'content': formatted_prompt}])
     #return response['message']['content']
 
+def ollama_llm_stream(question, context):
+    """The answer of ollama_llm, yielded in pieces as the model generates them"""
+    formatted_prompt = f"Using this data: {context}. Answer to this prompt: {question}"
+    for chunk in ollama.generate(model='llama3:70b', prompt = formatted_prompt, stream=True):
+        if chunk['response']:
+            yield chunk['response']
+
 # 3. Call Ollama Llama3 model
 def ollama_llm_first_question(question):
     formatted_prompt = f"""For this answer, you will answer a JSON object and only the JSON object Like this:
@@ -123,25 +111,35 @@ def ollama_llm_first_question(question):
 
 # 4. RAG Setup
 
-def retriever_obj(string_json):
-    vectorstore = process_and_embeddings(string_json)
-    retriever = vectorstore.as_retriever(k=20)
+def select_projects(question):
+    """Projects the question is about, asking the LLM only when it doesn't name any directly"""
+    projects = project_matcher.find(question)
+    if projects:
+        return projects
+    first_filter = ollama_llm_first_question(question)
+    return convert_keys_into_projects(convert_json_to_object(first_filter))
+
+def retriever_obj(projects):
+    # only the pages of the selected projects, the general report and the data files are searched,
+    # by vector similarity and BM25, whose rankings are fused before dropping near duplicate chunks
+    retriever = HybridRetriever(vectorstore, bm25_index.get(), projects + [GENERAL_KEY], k=rag_top_k)
     return retriever
 def combine_docs(docs):
     return "\n\n".join(doc.page_content for doc in docs)
 
 def rag_chain_inference(question):
-    first_filter = ollama_llm_first_question(question)
-    retriever = retriever_obj(first_filter)
+    retriever = retriever_obj(select_projects(question))
     retrieved_docs = retriever.invoke(question)
     formatted_context = combine_docs(retrieved_docs)
     return ollama_llm(question, formatted_context)
 
 def get_context_from_rag_chain(question):
-    first_filter = ollama_llm_first_question(question)
-    retriever = retriever_obj(first_filter)
+    retriever = retriever_obj(select_projects(question))
     retrieved_docs = retriever.invoke(question)
     formatted_context = combine_docs(retrieved_docs)
     return formatted_context
 
-
+def rag_chain_stream(question):
+    """rag_chain_inference, yielding the answer as it is generated"""
+    formatted_context = get_context_from_rag_chain(question)
+    yield from ollama_llm_stream(question, formatted_context)
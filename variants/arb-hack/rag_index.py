@@ -0,0 +1,121 @@
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+from langchain_community.vectorstores import Chroma
+from langchain_community.embeddings import OllamaEmbeddings
+from langchain_core.documents import Document
+import glob
+import hashlib
+import json
+import os
+
+from prompts import DATA_DIR
+from snapshots import load_manifest, load_snapshot_documents, refresh_snapshots
+
+# The embedded grant proposals and curated data files are kept on disk and reused by every question.
+# Run this file to refresh the page snapshots and the index: only pages whose content changed are embedded again.
+INDEX_DIR = "/home/fair-node/Desktop/arb-hack/chroma_index"
+COLLECTION_NAME = "ltipp"
+
+# pages searched for every question, whatever projects it is about
+GENERAL_KEY = "_general"
+GENERAL_URLS = ['https://www.openblocklabs.com/research/arbitrum-ltipp-efficacy-analysis'] # this is to include the report and provide better answers
+
+def open_index():
+    embeddings = OllamaEmbeddings(model="nomic-embed-text")
+    return Chroma(collection_name=COLLECTION_NAME, embedding_function=embeddings, persist_directory=INDEX_DIR)
+
+def content_hash(docs):
+    digest = hashlib.sha256()
+    for doc in docs:
+        digest.update(doc.page_content.encode('utf-8'))
+    return digest.hexdigest()
+
+def project_pages(ltipp_map):
+    """(project key, url) of every page to index"""
+    pages = [(GENERAL_KEY, url) for url in GENERAL_URLS]
+    pages += [(key, url) for key, urls in ltipp_map.items() for url in urls]
+    return pages
+
+def data_documents():
+    """The curated data/*.txt files, searched for every question like the general pages"""
+    docs = {}
+    for path in sorted(glob.glob(os.path.join(DATA_DIR, "*.txt"))):
+        source = "data/" + os.path.basename(path)
+        with open(path, "r") as file_data:
+            docs[source] = [Document(page_content=file_data.read(), metadata={"source": source})]
+    return docs
+
+def index_documents(vectorstore, text_splitter, project, source, docs):
+    """Embeds docs as the chunks of source for project, unless they are indexed already with the same content. Returns whether they were embedded."""
+    page_hash = content_hash(docs)
+    indexed = vectorstore.get(where={"source": source}, include=["metadatas"])
+    if indexed['ids'] and all(m.get('content_hash') == page_hash and m.get('project') == project for m in indexed['metadatas']):
+        return False
+
+    splits = text_splitter.split_documents(docs)
+    for split in splits:
+        split.metadata.update(source=source, project=project, content_hash=page_hash)
+    # the new chunks are added before the old ones go, so the page is never missing from the index;
+    # ids start with a hash of the source too, so identical content at two sources never shares ids
+    prefix = f"{hashlib.sha256(source.encode('utf-8')).hexdigest()[:8]}-{page_hash[:16]}-"
+    if splits:
+        vectorstore.add_documents(splits, ids=[f"{prefix}{i}" for i in range(len(splits))])
+    stale_ids = [id for id in indexed['ids'] if not id.startswith(prefix)]
+    if stale_ids:
+        vectorstore.delete(ids=stale_ids)
+    return True
+
+def index_data_files(vectorstore, text_splitter=None):
+    """Embeds the new or changed data files. Returns the sources of all of them and how many were embedded."""
+    text_splitter = text_splitter or new_text_splitter()
+    data = data_documents()
+    embedded = 0
+    for source, docs in data.items():
+        embedded += index_documents(vectorstore, text_splitter, GENERAL_KEY, source, docs)
+    return set(data), embedded
+
+def index_url(vectorstore, text_splitter, project, url, manifest):
+    """Embeds the snapshot of url for project, unless it is indexed already with the same content. Returns whether it was embedded."""
+    docs = load_snapshot_documents([url], manifest)
+    if not docs:
+        return False
+    return index_documents(vectorstore, text_splitter, project, url, docs)
+
+def new_text_splitter():
+    return RecursiveCharacterTextSplitter(chunk_size=2000, chunk_overlap=200)
+
+def update_index(ltipp_map, vectorstore=None):
+    """Brings the index in line with the data files and the snapshots of the project pages of ltipp_map, re-embedding only new or changed ones"""
+    vectorstore = vectorstore or open_index()
+    text_splitter = new_text_splitter()
+    pages = project_pages(ltipp_map)
+    manifest = load_manifest()
+
+    embedded = 0
+    for project, url in pages:
+        try:
+            embedded += index_url(vectorstore, text_splitter, project, url, manifest)
+        except Exception as e:
+            # the page keeps its previous chunks until it can be indexed again
+            print(f"Could not index {url}: {e}")
+    data_sources, data_embedded = index_data_files(vectorstore, text_splitter)
+    embedded += data_embedded
+
+    # pages removed from ltipp_map, and deleted data files, are removed from the index
+    current_urls = {url for _, url in pages} | data_sources
+    indexed = vectorstore.get(include=["metadatas"])
+    removed_ids = [id for id, m in zip(indexed['ids'], indexed['metadatas']) if m.get('source') not in current_urls]
+    if removed_ids:
+        vectorstore.delete(ids=removed_ids)
+
+    print(f"Index up to date: {embedded} of {len(pages) + len(data_sources)} pages embedded, {len(removed_ids)} stale chunks removed")
+    return vectorstore
+
+def is_empty(vectorstore):
+    return not vectorstore.get(limit=1)['ids']
+
+
+if __name__ == '__main__':
+    with open("/home/fair-node/Desktop/arb-hack/ltipp.json", "r") as file_ltipp_map:
+        ltipp_map = json.load(file_ltipp_map)
+    refresh_snapshots([url for _, url in project_pages(ltipp_map)])
+    update_index(ltipp_map)
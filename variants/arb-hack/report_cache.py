@@ -0,0 +1,110 @@
+import glob
+import os
+import threading
+import time
+
+from prompts import BASE_DIR, inputs_hash, load_prompts
+
+REPORTS_DIR = os.path.join(BASE_DIR, "reports_cache")
+
+class ReportCache:
+    """
+    The report, served from memory and regenerated in the background (stale-while-revalidate).
+
+    At most every check_interval_s, a request hashes the prompts and the data files: when the hash
+    changed, or the report is older than max_age_s, generate(prompts) runs on a background thread
+    while requests keep getting the previous report. generate returns (report, complete); a report
+    with failed sections is only served when there is nothing better. After a failed or incomplete
+    generation the next one waits backoff_s, doubling with every failure in a row up to
+    max_backoff_s, so a backend that is down isn't asked for a whole report every check.
+    Complete reports are saved as reports_dir/report-<hash>.txt so a restart with the same
+    inputs serves them right away.
+    """
+    def __init__(self, generate, reports_dir=REPORTS_DIR, max_age_s=86400, check_interval_s=60, backoff_s=60, max_backoff_s=3600):
+        self.generate = generate
+        self.reports_dir = reports_dir
+        self.max_age_s = max_age_s
+        self.check_interval_s = check_interval_s
+        self.backoff_s = backoff_s
+        self.max_backoff_s = max_backoff_s
+        self.lock = threading.Lock()
+        self.report = None
+        self.key = None
+        self.generated_at = 0
+        self.checked_at = 0
+        self.refreshing = False
+        self.failures = 0
+        self.retry_at = 0
+        self.load()
+
+    def path(self, key):
+        return os.path.join(self.reports_dir, f"report-{key[:16]}.txt")
+
+    def read(self, path):
+        with open(path, "r", encoding="utf-8") as file:
+            return file.read()
+
+    def load(self):
+        """Reads the saved report of the current inputs, or else the newest saved one as a stale report"""
+        try:
+            key = inputs_hash(load_prompts())
+        except Exception as e:
+            print(f"Could not read the report inputs: {e}")
+            key = None
+        if key and os.path.exists(self.path(key)):
+            self.report = self.read(self.path(key))
+            self.key = key
+            self.generated_at = os.path.getmtime(self.path(key))
+            return
+        saved = [path for path in glob.glob(os.path.join(self.reports_dir, "report*.txt")) if os.path.getsize(path)]
+        if saved:
+            self.report = self.read(max(saved, key=os.path.getmtime))
+
+    def get(self):
+        """The current report, or None while the first one is generated"""
+        with self.lock:
+            now = time.time()
+            if not self.refreshing and now >= self.retry_at and now - self.checked_at >= self.check_interval_s:
+                self.checked_at = now
+                try:
+                    prompts = load_prompts()
+                    key = inputs_hash(prompts)
+                except Exception as e:
+                    print(f"Could not read the report inputs: {e}")
+                    return self.report
+                if key != self.key or now - self.generated_at >= self.max_age_s:
+                    self.refreshing = True
+                    threading.Thread(target=self.refresh, args=(prompts, key), daemon=True).start()
+            return self.report
+
+    def refresh(self, prompts, key):
+        report, complete = None, False
+        try:
+            report, complete = self.generate(prompts)
+        except Exception as e:
+            print(f"Could not generate the report: {e}")
+        with self.lock:
+            self.refreshing = False
+            if report and (complete or self.report is None):
+                self.report = report
+            if complete:
+                self.key = key
+                self.generated_at = time.time()
+                self.failures = 0
+                self.retry_at = 0
+            else:
+                self.failures += 1
+                self.retry_at = time.time() + min(self.max_backoff_s, self.backoff_s * 2 ** (self.failures - 1))
+        if complete:
+            self.save(key, report)
+
+    def save(self, key, report):
+        os.makedirs(self.reports_dir, exist_ok=True)
+        tmp_path = self.path(key) + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            file.write(report)
+        os.replace(tmp_path, self.path(key))
+        # reports of previous inputs are never served again
+        for path in glob.glob(os.path.join(self.reports_dir, "report-*.txt")):
+            if path != self.path(key):
+                os.remove(path)
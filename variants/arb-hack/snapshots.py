@@ -0,0 +1,136 @@
+from bs4 import BeautifulSoup
+from concurrent.futures import ThreadPoolExecutor
+from langchain_core.documents import Document
+import datetime
+import gzip
+import hashlib
+import json
+import os
+import requests
+
+# Offline copies of the pages the RAG pipeline reads, so answering a question never waits on the network.
+# Page bodies are stored gzipped under the sha256 of their content, manifest.json maps each url to its
+# current body and the validators used to fetch it again only when it changed.
+SNAPSHOT_DIR = "/home/fair-node/Desktop/arb-hack/snapshots"
+MANIFEST_PATH = os.path.join(SNAPSHOT_DIR, "manifest.json")
+
+USER_AGENT = "Mozilla/5.0 (compatible; arb-hack snapshot)"
+
+def load_manifest():
+    try:
+        with open(MANIFEST_PATH, "r") as file_manifest:
+            return json.load(file_manifest)
+    except FileNotFoundError:
+        return {}
+
+def save_manifest(manifest):
+    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+    tmp_path = MANIFEST_PATH + ".tmp"
+    with open(tmp_path, "w") as file_manifest:
+        json.dump(manifest, file_manifest, indent=2, sort_keys=True)
+    os.replace(tmp_path, MANIFEST_PATH)
+
+def object_path(sha256):
+    return os.path.join(SNAPSHOT_DIR, "objects", sha256[:2], sha256 + ".gz")
+
+def write_object(content):
+    sha256 = hashlib.sha256(content).hexdigest()
+    path = object_path(sha256)
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + ".tmp"
+        with gzip.open(tmp_path, "wb") as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+    return sha256
+
+def read_object(sha256):
+    with gzip.open(object_path(sha256), "rb") as f:
+        return f.read()
+
+def fetch(session, url, entry, timeout):
+    """Fetches url, conditionally on the validators of its manifest entry. Returns the new entry, or entry when unchanged."""
+    headers = {}
+    if entry and entry.get("etag"):
+        headers["If-None-Match"] = entry["etag"]
+    if entry and entry.get("last_modified"):
+        headers["If-Modified-Since"] = entry["last_modified"]
+    response = session.get(url, headers=headers, timeout=timeout)
+    if response.status_code == 304 and entry:
+        return dict(entry, checked_at=datetime.datetime.utcnow().isoformat())
+    response.raise_for_status()
+    now = datetime.datetime.utcnow().isoformat()
+    return {
+        "sha256": write_object(response.content),
+        "etag": response.headers.get("ETag"),
+        "last_modified": response.headers.get("Last-Modified"),
+        "content_type": response.headers.get("Content-Type"),
+        "fetched_at": now,
+        "checked_at": now,
+    }
+
+def refresh_snapshots(urls, max_workers=8, timeout=30, only_missing=False):
+    """
+    Fetches the urls on at most max_workers connections and records them in the manifest.
+    Pages that fail keep their previous snapshot. only_missing skips the urls already snapshotted.
+    """
+    manifest = load_manifest()
+    urls = [url for url in dict.fromkeys(urls) if not (only_missing and url in manifest)]
+    if not urls:
+        return manifest
+
+    session = requests.Session()
+    session.headers["User-Agent"] = USER_AGENT
+    adapter = requests.adapters.HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+
+    changed = 0
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {url: executor.submit(fetch, session, url, manifest.get(url), timeout) for url in urls}
+        for url, future in futures.items():
+            try:
+                entry = future.result()
+            except Exception as e:
+                print(f"Could not fetch {url}: {e}")
+                continue
+            changed += entry.get("sha256") != manifest.get(url, {}).get("sha256")
+            manifest[url] = entry
+
+    save_manifest(manifest)
+    remove_unreferenced_objects(manifest)
+    print(f"Snapshots refreshed: {changed} of {len(urls)} pages changed")
+    return manifest
+
+def remove_unreferenced_objects(manifest):
+    referenced = {entry["sha256"] for entry in manifest.values()}
+    objects_dir = os.path.join(SNAPSHOT_DIR, "objects")
+    if not os.path.isdir(objects_dir):
+        return
+    for prefix in os.listdir(objects_dir):
+        for name in os.listdir(os.path.join(objects_dir, prefix)):
+            if name.endswith(".gz") and name[:-len(".gz")] not in referenced:
+                os.remove(os.path.join(objects_dir, prefix, name))
+
+def load_snapshot_documents(urls, manifest=None):
+    """Documents of the snapshotted pages, as WebBaseLoader would load them. Pages without a snapshot are skipped."""
+    manifest = manifest if manifest is not None else load_manifest()
+    docs = []
+    for url in urls:
+        entry = manifest.get(url)
+        if not entry:
+            print(f"No snapshot of {url}, run snapshots.py to fetch it")
+            continue
+        soup = BeautifulSoup(read_object(entry["sha256"]), "html.parser")
+        metadata = {"source": url}
+        if soup.find("title"):
+            metadata["title"] = soup.find("title").get_text()
+        docs.append(Document(page_content=soup.get_text(), metadata=metadata))
+    return docs
+
+
+if __name__ == '__main__':
+    from rag_index import project_pages
+    with open("/home/fair-node/Desktop/arb-hack/ltipp.json", "r") as file_ltipp_map:
+        ltipp_map = json.load(file_ltipp_map)
+    refresh_snapshots([url for _, url in project_pages(ltipp_map)])
@@ -1,24 +1,73 @@
 from ollama import chat
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, stream_with_context
 from flask_cors import CORS
+import json
+import os
+
+from sessions import SessionStore, truncate
 
 app = Flask(__name__)
 CORS(app) 
 
+# conversations sent with a session_id are kept here, so clients only send the new messages of each turn
+store = SessionStore(
+    ttl_s=float(os.environ.get("GENO_SESSION_TTL_S", 3600)),
+    max_sessions=int(os.environ.get("GENO_MAX_SESSIONS", 1000)),
+    max_tokens=int(os.environ.get("GENO_HISTORY_TOKENS", 6000)),
+    directory=os.environ.get("GENO_SESSION_DIR"),  # unset keeps sessions in memory only
+)
+# how long Ollama keeps llama3 and its cache of the conversation prefix loaded between turns
+keep_alive = os.environ.get("GENO_KEEP_ALIVE", "30m")
+
+def stream_chat(messages, finish):
+    """
+    NDJSON lines: {"token": ...} as the model generates the answer, then
+    {"done": true, ...finish(answer)}
+    """
+    answer = ""
+    try:
+        for chunk in chat('llama3', messages = messages, stream = True, keep_alive = keep_alive):
+            token = chunk['message']['content']
+            if token:
+                answer += token
+                yield json.dumps({'token': token}) + "\n"
+    except Exception as e:
+        print(f"Could not generate the answer: {e}")
+        yield json.dumps({'error': 'It was not possible to generate this answer due to a temporary issue'}) + "\n"
+        return
+
+    yield json.dumps(dict(finish(answer), done=True)) + "\n"
+
 @app.route('/process', methods=['POST'])
 def process():
     data = request.get_json()
     messages = data.get('messages', [])
-    response = chat('llama3', messages = messages)
-    
-    # append the response to messages to answer the full history
-    messages.append(response['message'])
-    
-    #create full answer, history and the real answer
-    full_answer = {
-        'messages': messages,
-        'answer': response['message']['content']
-    }
+
+    if 'session_id' in data:
+        # messages only holds the new messages, the history is added from the session, a null id starts one
+        session_id = data['session_id'] or store.new_id()
+        if not store.valid_id(session_id):
+            return jsonify({'error': 'Invalid session_id'}), 400
+        messages = truncate(store.get(session_id) + messages, store.max_tokens)
+
+        def finish(answer):
+            # the history is the prompt that was sent, truncated once, and its answer
+            store.put(session_id, messages + [{'role': 'assistant', 'content': answer}])
+            return {'session_id': session_id, 'answer': answer}
+    else:
+        def finish(answer):
+            # append the response to messages to answer the full history
+            messages.append({'role': 'assistant', 'content': answer})
+            return {'messages': messages, 'answer': answer}
+
+    # with "stream": true the answer is sent as NDJSON while it is generated, proxies must not buffer it
+    if data.get('stream', False):
+        return Response(stream_with_context(stream_chat(messages, finish)), mimetype='application/x-ndjson', headers={'X-Accel-Buffering': 'no'})
+
+    response = chat('llama3', messages = messages, keep_alive = keep_alive)
+
+    #create full answer, history (or session id) and the real answer
+    full_answer = finish(response['message']['content'])
 
     return jsonify(full_answer)
 
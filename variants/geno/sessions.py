@@ -0,0 +1,154 @@
+from collections import OrderedDict
+import json
+import os
+import re
+import threading
+import time
+import uuid
+
+SESSION_ID = re.compile(r"[A-Za-z0-9_-]{1,64}")
+
+def estimate_tokens(message):
+    # llama3 reads about 4 characters of English per token, plus a few tokens of chat template per message
+    return len(message.get('content') or '') // 4 + 4
+
+def truncate(messages, max_tokens):
+    """
+    The leading system messages and as many of the latest messages as fit in max_tokens.
+
+    Old messages are dropped in one block, down to half of max_tokens, instead of one by one every
+    turn: the kept history then stays a stable prefix for many turns, which Ollama evaluates once
+    and reuses from its cache instead of reading the whole conversation again on every turn.
+    """
+    system = 0
+    while system < len(messages) and messages[system].get('role') == 'system':
+        system += 1
+    if sum(estimate_tokens(message) for message in messages) <= max_tokens:
+        return messages
+
+    budget = max_tokens // 2 - sum(estimate_tokens(message) for message in messages[:system])
+    # the latest turn, from its question on, is always kept, even when it alone is over the budget
+    last_question = max((i for i in range(system, len(messages)) if messages[i].get('role') == 'user'), default=len(messages) - 1)
+    start = last_question
+    budget -= sum(estimate_tokens(message) for message in messages[start:])
+    while start > system and estimate_tokens(messages[start - 1]) <= budget:
+        start -= 1
+        budget -= estimate_tokens(messages[start])
+    # the kept history starts with a question, not with an answer to a dropped one
+    while start < last_question and messages[start].get('role') != 'user':
+        start += 1
+    return messages[:system] + messages[start:]
+
+class SessionStore:
+    """
+    Conversation histories kept server side, by session id.
+
+    Sessions idle for ttl_s expire, and past max_sessions the least recently used ones leave memory.
+    With a directory, every session is also saved there as <session id>.json, so it survives
+    restarts and evictions until it expires, expired sessions being purged from memory and disk at
+    most every purge_interval_s. Prompts are built with truncate(history + new messages, max_tokens).
+    """
+    def __init__(self, ttl_s=3600, max_sessions=1000, max_tokens=6000, directory=None, purge_interval_s=60):
+        self.ttl_s = ttl_s
+        self.max_sessions = max_sessions
+        self.max_tokens = max_tokens
+        self.directory = directory
+        self.purge_interval_s = purge_interval_s
+        self.purged_at = time.time()
+        self.lock = threading.Lock()
+        self.sessions = OrderedDict()  # session id -> (messages, last used time)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            self.remove_expired_files()
+
+    def new_id(self):
+        return uuid.uuid4().hex
+
+    def valid_id(self, session_id):
+        return isinstance(session_id, str) and SESSION_ID.fullmatch(session_id) is not None
+
+    def path(self, session_id):
+        return os.path.join(self.directory, session_id + ".json")
+
+    def get(self, session_id):
+        """The history of the session, empty for a new or expired one"""
+        with self.lock:
+            self.purge()
+            messages = self.history(session_id)
+            self.sessions[session_id] = (messages, time.time())
+            self.sessions.move_to_end(session_id)
+            self.evict()
+            return list(messages)
+
+    def put(self, session_id, messages):
+        """
+        Stores messages as the history of the session, as they are: the prompt of the turn, already
+        truncated, and its answer, so the next turn starts with exactly the prefix Ollama just cached
+        """
+        with self.lock:
+            self.purge()
+            history = list(messages)
+            self.sessions.pop(session_id, None)
+            self.sessions[session_id] = (history, time.time())
+            self.evict()
+            if self.directory:
+                self.save(session_id, history)
+
+    def history(self, session_id):
+        """The stored history of the session, from memory or else from disk, empty when there is none or it expired"""
+        entry = self.sessions.get(session_id)
+        if entry is None and self.directory:
+            entry = self.load(session_id)
+        if entry is None:
+            return []
+        messages, used_at = entry
+        if time.time() - used_at >= self.ttl_s:
+            self.remove(session_id)
+            return []
+        return messages
+
+    def purge(self):
+        """Removes the expired sessions, at most every purge_interval_s"""
+        now = time.time()
+        if now - self.purged_at < self.purge_interval_s:
+            return
+        self.purged_at = now
+        for session_id in [session_id for session_id, (_, used_at) in self.sessions.items() if now - used_at >= self.ttl_s]:
+            self.remove(session_id)
+        if self.directory:
+            self.remove_expired_files()
+
+    def evict(self):
+        while len(self.sessions) > self.max_sessions:
+            self.sessions.popitem(last=False)
+
+    def remove(self, session_id):
+        self.sessions.pop(session_id, None)
+        if self.directory and os.path.exists(self.path(session_id)):
+            os.remove(self.path(session_id))
+
+    def load(self, session_id):
+        try:
+            with open(self.path(session_id), "r") as file_session:
+                session = json.load(file_session)
+        except (FileNotFoundError, ValueError):
+            return None
+        return session['messages'], session['used_at']
+
+    def save(self, session_id, messages):
+        tmp_path = self.path(session_id) + ".tmp"
+        with open(tmp_path, "w") as file_session:
+            json.dump({'messages': messages, 'used_at': time.time()}, file_session)
+        os.replace(tmp_path, self.path(session_id))
+
+    def remove_expired_files(self):
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            # sessions in memory expire by their last use there, which can be later than their last save
+            if name[:-len(".json")] in self.sessions:
+                continue
+            try:
+                if name.endswith(".json") and time.time() - os.path.getmtime(path) >= self.ttl_s:
+                    os.remove(path)
+            except FileNotFoundError:
+                pass